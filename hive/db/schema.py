@@ -222,6 +222,27 @@ hive_posts_cache = sa.Table(
     mysql_default_charset='utf8mb4'
 )
 
+# per-block undo log for reversible blocks; see hive.indexer.undo
+hive_undo = sa.Table(
+    'hive_undo', metadata,
+    sa.Column('num', sa.Integer, primary_key=True, autoincrement=False),
+    sa.Column('entries', MEDIUMTEXT, nullable=False),
+    mysql_engine='InnoDB',
+    mysql_default_charset='utf8mb4'
+)
+
+# posts whose cache rows await a refresh; see hive.indexer.cache
+hive_dirty_posts = sa.Table(
+    'hive_dirty_posts', metadata,
+    sa.Column('post_id', sa.Integer, primary_key=True, autoincrement=False),
+    sa.Column('payout_at', sa.DateTime, nullable=False),
+    sa.Column('touched_at', sa.DateTime, nullable=False),
+    sa.Index('hive_dirty_posts_ix1', 'payout_at'),
+    sa.Index('hive_dirty_posts_ix2', 'touched_at'),
+    mysql_engine='InnoDB',
+    mysql_default_charset='utf8mb4'
+)
+
 
 _url = os.environ.get('DATABASE_URL', 'missing ENV DATABASE_URL')
 logging.basicConfig()
@@ -254,6 +275,12 @@ def setup(connection_url=_url):
     ])
 
 
+def upgrade(connection_url=_url):
+    """ Create any tables added since the db was set up. """
+    engine = sa.create_engine(connection_url + "?charset=utf8mb4")
+    metadata.create_all(engine)
+
+
 def teardown(connection_url=_url):
     engine = sa.create_engine(connection_url)
     metadata.drop_all(engine)
@@ -0,0 +1,78 @@
+import collections
+import re
+
+from hive.db.methods import query, query_all, query_one
+from hive.indexer import undo
+
+# process-wide name -> id map of hive_accounts. loaded once on first use
+# and kept current by `register`, so existence checks never hit the db.
+# names are kept lower-case: the name column compares case-insensitively.
+_ids = {}
+_loaded = False
+
+# new accounts are buffered for the length of a block batch and written
+# with one multi-row INSERT. ids are allocated here, so lookups see them
+# before the rows are written.
+_last_id = None
+_pending = collections.OrderedDict()
+
+
+def is_valid_account_name(name):
+    return re.match('^[a-z][a-z0-9\-.]{2,15}$', name)
+
+
+def load_ids():
+    global _ids, _loaded, _last_id
+    _ids = {name.lower(): aid for name, aid in
+            query_all("SELECT name, id FROM hive_accounts")}
+    _loaded = True
+    _last_id = None
+    _pending.clear()
+    print("[INIT] Loaded {} account ids".format(len(_ids)))
+
+
+def get_id(name):
+    if not _loaded:
+        load_ids()
+    return _ids.get(name.lower()) if name else None
+
+
+def exists(name):
+    return bool(name) and get_id(name) is not None
+
+
+def is_pending(name):
+    return bool(name) and name.lower() in _pending
+
+
+def _next_id():
+    global _last_id
+    if _last_id is None:
+        _last_id = query_one("SELECT IFNULL(MAX(id), 0) FROM hive_accounts")
+    _last_id += 1
+    return _last_id
+
+
+# note any accounts not yet known; written out by `flush`
+def register(names, date):
+    for name in set(names):
+        if not exists(name):
+            aid = _next_id()
+            _ids[name.lower()] = aid
+            _pending[name.lower()] = (aid, name, date)
+
+
+def flush():
+    """ Write buffered hive_accounts rows, 1000 per INSERT. """
+    rows = list(_pending.values())
+    if rows:
+        undo.snapshot('hive_accounts', 'id IN :ids', ids=tuple(r[0] for r in rows))
+    for i in range(0, len(rows), 1000):
+        params = {}
+        vals = []
+        for j, (aid, name, date) in enumerate(rows[i:i+1000]):
+            vals.append("(:id%d, :n%d, :at%d)" % (j, j, j))
+            params.update({'id%d' % j: aid, 'n%d' % j: name, 'at%d' % j: date})
+        sql = "INSERT INTO hive_accounts (id, name, created_at) VALUES "
+        query(sql + ','.join(vals), **params)
+    _pending.clear()
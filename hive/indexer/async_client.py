@@ -0,0 +1,259 @@
+# coding=utf-8
+import asyncio
+import gzip
+import json
+import logging
+import random
+import ssl
+import time
+from collections import deque
+from urllib.parse import urlparse
+
+import certifi
+
+from .http_client import HttpClient, RPCError, _percentile
+from .json_stream import loads
+
+logger = logging.getLogger(__name__)
+
+RETRY_ERRORS = (OSError, EOFError, asyncio.TimeoutError)
+
+
+class AsyncHttpClient(object):
+    """ asyncio Steem JSON-HTTP-RPC client.
+
+    Requests are sent over a pool of keep-alive HTTP/1.1 connections, one
+    per in-flight request, all driven by a single event loop: hundreds of
+    concurrent calls cost sockets, not threads. Failed requests are retried
+    with capped, jittered backoff, failing over to the next node.
+
+    Coroutines must be run on one loop; see AsyncSteemAdapter for a
+    blocking facade.
+
+    Args:
+      nodes (list): A list of Steem HTTP RPC nodes to connect to.
+      max_connections (int): Cap on open connections across all nodes.
+    """
+
+    def __init__(self, nodes, **kwargs):
+        self.nodes = [urlparse(url) for url in nodes]
+        self.max_connections = kwargs.get('max_connections', 500)
+        self.timeout = kwargs.get('timeout', 60)
+        self.max_retries = kwargs.get('max_retries', 10)
+        self.backoff_base = kwargs.get('backoff_base', 0.1)
+        self.backoff_cap = kwargs.get('backoff_cap', 10)
+        self.load_balance = False
+
+        self._node = 0
+        self._idle = {}     # netloc -> [(reader, writer)]
+        self._slots = None  # created on the loop, see _post
+        self._ssl = ssl.create_default_context(cafile=certifi.where())
+        self._latencies = deque(maxlen=1000)
+        self.stats = dict(requests=0, retries=0, hedged=0, hedge_wins=0,
+                          breaker_trips=0, connections=0)
+
+    def metrics(self):
+        """ Request counters and latency percentiles (seconds) over the
+        last 1000 requests. """
+        out = dict(self.stats)
+        window = list(self._latencies)
+        for pct in (50, 90, 99):
+            out['p%d' % pct] = round(_percentile(window, pct), 3) if window else None
+        return out
+
+    async def _connect(self, url):
+        https = url.scheme == 'https'
+        self.stats['connections'] += 1
+        return await asyncio.open_connection(
+            url.hostname, url.port or (443 if https else 80),
+            ssl=self._ssl if https else None)
+
+    async def _roundtrip(self, url, reader, writer, body):
+        """ Send one POST; returns (status, body, keep_alive). """
+        head = ("POST {} HTTP/1.1\r\n"
+                "Host: {}\r\n"
+                "Content-Type: application/json\r\n"
+                "Accept-Encoding: gzip\r\n"
+                "Content-Length: {}\r\n\r\n").format(
+                    url.path or '/', url.netloc, len(body))
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError('connection closed by server')
+        version, status = status_line.split(None, 2)[:2]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = (version != b'HTTP/1.0'
+                      and headers.get('connection', '').lower() != 'close')
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            parts = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if not size:
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                parts.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            data = b''.join(parts)
+        elif 'content-length' in headers:
+            data = await reader.readexactly(int(headers['content-length']))
+        else:
+            data = await reader.read()
+            keep_alive = False
+
+        if headers.get('content-encoding', '').lower() == 'gzip':
+            data = gzip.decompress(data)
+        return int(status), data, keep_alive
+
+    async def _post(self, url, body):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_connections)
+        idle = self._idle.setdefault(url.netloc, [])
+
+        await self._slots.acquire()
+        try:
+            while True:
+                reused = bool(idle)
+                if reused:
+                    reader, writer = idle.pop()
+                else:
+                    reader, writer = await asyncio.wait_for(
+                        self._connect(url), self.timeout)
+                try:
+                    status, data, keep_alive = await asyncio.wait_for(
+                        self._roundtrip(url, reader, writer, body), self.timeout)
+                except RETRY_ERRORS:
+                    writer.close()
+                    if reused:
+                        # the server may have dropped an idle connection
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                if keep_alive:
+                    idle.append((reader, writer))
+                else:
+                    writer.close()
+                return status, data
+        finally:
+            self._slots.release()
+
+    async def _send(self, body):
+        """ POST `body`, retrying with capped jittered backoff and failing
+        over to the next node. Returns the response body. """
+        attempt = 0
+        while True:
+            url = self.nodes[self._node % len(self.nodes)]
+            self.stats['requests'] += 1
+            lap = time.time()
+            try:
+                status, data = await self._post(url, body)
+            except RETRY_ERRORS as e:
+                if attempt >= self.max_retries:
+                    raise e
+                attempt += 1
+                self.stats['retries'] += 1
+                self._node += 1
+                delay = random.uniform(0, min(self.backoff_cap,
+                                              self.backoff_base * 2 ** attempt))
+                logging.debug('Retrying in %.2fs due to exception: %s' %
+                              (delay, e.__class__.__name__))
+                await asyncio.sleep(delay)
+                continue
+            self._latencies.append(time.time() - lap)
+            if status != 200:
+                logger.info('non 200 response:%s', status)
+            return data
+
+    @staticmethod
+    def _result(response_json):
+        if isinstance(response_json, dict) and 'error' in response_json:
+            error = response_json['error']
+            raise RPCError("{}: {}".format(
+                error.get('detail', error.get('message')), response_json))
+        if isinstance(response_json, dict):
+            return response_json.get('result', None)
+        return response_json
+
+    async def exec(self, name, *args, api=None):
+        """ Execute a method against steemd RPC. """
+        body = HttpClient.json_rpc_body(name, *args, api=api)
+        data = await self._send(body)
+        return self._result(loads(data))
+
+    @staticmethod
+    async def _gather(fn, items, limit):
+        """ Run `fn` over `items` with at most `limit` in flight; results
+        are returned in order. """
+        slots = asyncio.Semaphore(limit)
+
+        async def run(item):
+            async with slots:
+                return await fn(item)
+
+        return await asyncio.gather(*[run(item) for item in items])
+
+    async def exec_multi(self, name, params, inflight=100, controller=None):
+        """ Results of one request per entry of `params`, in order. """
+        def ensure_list(parameter):
+            return parameter if type(parameter) in (list, tuple, set) else [parameter]
+
+        async def call(param):
+            lap = time.time()
+            try:
+                result = await self.exec(name, *ensure_list(param))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                if controller:
+                    controller.record(1, time.time() - lap, error=True)
+                raise
+            if controller:
+                controller.record(1, time.time() - lap)
+            return result
+
+        if controller:
+            inflight = controller.inflight
+        return await self._gather(call, params, inflight)
+
+    async def exec_batch(self, name, params, batch_size=100, inflight=4,
+                         controller=None):
+        """ Results of `name` for each of `params`, in order, sent as
+        JSON-RPC batches. """
+        if controller:
+            batch_size, inflight = controller.batch_size, controller.inflight
+        params = list(params)
+        batches = [params[i:i+batch_size] for i in range(0, len(params), batch_size)]
+
+        async def call(batch):
+            body = json.dumps([{"method": name, "params": param,
+                                "jsonrpc": "2.0", "id": i}
+                               for i, param in enumerate(batch)]).encode()
+            lap = time.time()
+            try:
+                data = await self._send(body)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                if controller:
+                    controller.record(len(batch), time.time() - lap, error=True)
+                raise
+            if controller:
+                controller.record(len(batch), time.time() - lap, len(data))
+            batch_response = self._result(loads(data))
+            assert batch_response, "batch_response was empty"
+            assert len(batch_response) == len(batch), "batch_response len did not match params ({} vs {})".format(len(batch_response), len(batch))
+            return [response['result'] for response in batch_response]
+
+        results = await self._gather(call, batches, inflight)
+        return [result for batch in results for result in batch]
@@ -0,0 +1,142 @@
+# coding=utf-8
+""" Local store of raw irreversible blocks, so reindexes can replay them
+from disk instead of steemd.
+
+Blocks are kept contiguously from the first one stored, in segments of
+SEGMENT_BLOCKS. Each segment is a pair of append-only files:
+
+    (first block).dat  block JSON, one record after another
+    (first block).idx  dense index: uint64 end offset of each record
+
+A record is written before its index entry, so a crash can only leave an
+unindexed tail, which is truncated when the store is next opened.
+"""
+import glob
+import json
+import os
+import struct
+import threading
+
+from .json_stream import loads
+
+SEGMENT_BLOCKS = 100000
+
+_OFFSET = struct.Struct('<Q')
+
+
+class _Segment(object):
+    def __init__(self, path, base):
+        self.base = base
+        self.data_path = os.path.join(path, '%09d.dat' % base)
+        self.idx_path = os.path.join(path, '%09d.idx' % base)
+        self.ends = []
+        if os.path.exists(self.idx_path):
+            with open(self.idx_path, 'rb') as f:
+                raw = f.read()
+            raw = raw[:len(raw) - len(raw) % _OFFSET.size]
+            self.ends = [end for (end,) in _OFFSET.iter_unpack(raw)]
+        self._repair()
+        self._data = open(self.data_path, 'ab')
+        self._idx = open(self.idx_path, 'ab')
+        self._reader = open(self.data_path, 'rb')
+
+    def _repair(self):
+        size = os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+        while self.ends and self.ends[-1] > size:
+            self.ends.pop()
+        size = self.ends[-1] if self.ends else 0
+        with open(self.data_path, 'ab') as f:
+            f.truncate(size)
+        with open(self.idx_path, 'ab') as f:
+            f.truncate(len(self.ends) * _OFFSET.size)
+
+    @property
+    def last(self):
+        return self.base + len(self.ends) - 1
+
+    def append(self, raw):
+        self._data.write(raw)
+        self._data.flush()
+        self.ends.append((self.ends[-1] if self.ends else 0) + len(raw))
+        self._idx.write(_OFFSET.pack(self.ends[-1]))
+        self._idx.flush()
+
+    def read(self, lbound, ubound):
+        """ Raw records for blocks [lbound, ubound), read in one go. """
+        first, last = lbound - self.base, ubound - self.base
+        start = self.ends[first - 1] if first else 0
+        self._reader.seek(start)
+        buf = self._reader.read(self.ends[last - 1] - start)
+        return [buf[(self.ends[i - 1] if i else 0) - start:self.ends[i] - start]
+                for i in range(first, last)]
+
+    def close(self):
+        for f in (self._data, self._idx, self._reader):
+            f.close()
+
+
+class BlockStore(object):
+    """ Append-only on-disk cache of blocks, read back by number.
+
+    Only the next block after `head` can be added, so the stored range
+    never has gaps. """
+
+    def __init__(self, path):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._segments = []
+        for idx_path in sorted(glob.glob(os.path.join(path, '*.idx'))):
+            base = int(os.path.basename(idx_path)[:-4])
+            if self._segments and base != self._segments[-1].last + 1:
+                raise Exception("block store {} has a gap before {}".format(
+                    path, idx_path))
+            self._segments.append(_Segment(path, base))
+        if self.head:
+            print("[INIT] Block store has blocks {} to {}".format(self.first, self.head))
+
+    @property
+    def first(self):
+        return self._segments[0].base if self._segments else None
+
+    @property
+    def head(self):
+        """ Last stored block number, or None if the store is empty. """
+        return self._segments[-1].last if self._segments else None
+
+    def has(self, num):
+        return bool(self._segments) and self.first <= num <= self.head
+
+    def append(self, num, block):
+        """ Store `block` if it extends the stored range; returns True if
+        it was written. """
+        with self._lock:
+            if self._segments and num != self.head + 1:
+                return False
+            seg = self._segments[-1] if self._segments else None
+            if not seg or len(seg.ends) == SEGMENT_BLOCKS:
+                seg = _Segment(self.path, num)
+                self._segments.append(seg)
+            seg.append(json.dumps(block, separators=(',', ':')).encode('utf-8'))
+            return True
+
+    def get(self, num):
+        return self.get_range(num, num + 1)[0]
+
+    def get_range(self, lbound, ubound):
+        """ Blocks [lbound, ubound), all of which must be stored. """
+        assert self.has(lbound) and self.has(ubound - 1), \
+            "blocks {}-{} not in store".format(lbound, ubound - 1)
+        out = []
+        with self._lock:
+            for seg in self._segments:
+                lo, hi = max(lbound, seg.base), min(ubound, seg.last + 1)
+                if lo < hi:
+                    out.extend(seg.read(lo, hi))
+        return [loads(raw) for raw in out]
+
+    def close(self):
+        with self._lock:
+            for seg in self._segments:
+                seg.close()
+            self._segments = []
@@ -4,9 +4,11 @@ import math
 import collections
 import time
 import re
+import heapq
 
+from datetime import datetime, timedelta
 from funcy.seqs import first
-from hive.db.methods import query, query_all, query_col
+from hive.db.methods import query, query_all, query_col, query_one
 from hive.indexer.utils import amount, parse_time, get_adapter
 
 logger = logging.getLogger(__name__)
@@ -176,10 +178,16 @@ def get_stats(post):
 
 def batch_queries(batches):
     query("START TRANSACTION")
+    write_queries(batches)
+    query("COMMIT")
+    schedule_payouts(batches)
+
+
+# run queries in the caller's transaction
+def write_queries(batches):
     for queries in batches:
         for (sql, params) in queries:
             query(sql, **params)
-    query("COMMIT")
 
 
 # calculate UI rep score
@@ -333,13 +341,8 @@ def update_posts_batch(tuples, steemd, updated_at=None):
     for i in range(0, total, 1000):
 
         lap_0 = time.time()
-        buffer = []
-        for post in steemd.get_content_batch(posts[i:i+1000]):
-            if not post['author']:
-                continue # post has been deleted
-            url = post['author'] + '/' + post['permlink']
-            sql = generate_cached_post_sql(ids[url], post, updated_at)
-            buffer.append(sql)
+        contents = steemd.get_content_batch(posts[i:i+1000])
+        buffer = cached_posts_sql(ids, contents, updated_at)
 
         lap_1 = time.time()
         batch_queries(buffer)
@@ -355,6 +358,76 @@ def update_posts_batch(tuples, steemd, updated_at=None):
                 processed, total, round(rate, 1), rps, wps, round(rem / rate / 60, 2)))
 
 
+def fetch_posts(urls, steemd):
+    """ Chain state of posts by url, fetched without touching the db. """
+    posts = [url.split('/') for url in urls]
+    return dict(zip(urls, steemd.get_content_batch(posts))) if posts else {}
+
+
+def cached_posts_sql(ids, contents, updated_at):
+    """ Cache queries for fetched posts, given a url->id map. """
+    buffer = []
+    for post in contents:
+        if not post['author']:
+            continue # post has been deleted
+        url = post['author'] + '/' + post['permlink']
+        buffer.append(generate_cached_post_sql(ids[url], post, updated_at))
+    return buffer
+
+
+# votes
+# -----
+# vote ops carry no rshares, so a post which was only voted on is updated
+# from get_active_votes rather than a full get_content: still one request
+# per post, but without the body, and batched through jussi. only rshares,
+# votes and scores are rewritten; payout, promoted and the other pending
+# fields keep the values of the last full refresh, so they lag by up to
+# FULL_REFRESH_AGE. posts which are not cached, are paid out, lost a voter,
+# or were last fully refreshed longer ago than that get a full refresh.
+
+FULL_REFRESH_AGE = timedelta(minutes=10)
+
+
+def vote_updates_sql(tuples, steemd, date):
+    """ Returns queries updating the votes of the given posts, and the
+    tuples of those which need a full refresh. """
+    if not tuples:
+        return [], []
+    sql = ("SELECT post_id, created_at, updated_at, is_paidout, votes "
+           "FROM hive_posts_cache WHERE post_id IN :ids")
+    cached = {row[0]: row for row in query_all(sql, ids=tuple(t[0] for t in tuples))}
+
+    date = _as_time(date)
+    light, stale = [], []
+    for tup in tuples:
+        row = cached.get(tup[0])
+        if not row or row[3] or date - row[2] > FULL_REFRESH_AGE:
+            stale.append(tup)
+        else:
+            light.append(tup)
+
+    buffer = []
+    votes = steemd.get_active_votes_batch([[a, p] for _, a, p in light]) if light else []
+    for tup, active_votes in zip(light, votes):
+        _, created_at, _, _, csvotes = cached[tup[0]]
+        voters = set(line.split(',')[0] for line in (csvotes or '').split("\n") if line)
+        if not voters <= set(vote['voter'] for vote in active_votes):
+            stale.append(tup)
+            continue
+
+        rshares = sum(int(v['rshares']) for v in active_votes)
+        timestamp = created_at.timestamp()
+        sql = ("UPDATE hive_posts_cache SET rshares = :rshares, votes = :votes, "
+               "sc_trend = :sc_trend, sc_hot = :sc_hot WHERE post_id = :id")
+        buffer.append([(sql, {
+            'id': tup[0],
+            'rshares': "%d" % rshares,
+            'votes': "\n".join(map(vote_csv_row, active_votes)),
+            'sc_trend': "%f" % score(rshares, timestamp, 480000),
+            'sc_hot': "%f" % score(rshares, timestamp, 10000)})])
+    return buffer, stale
+
+
 # the feed cache allows for efficient querying of blogs+reblogs. this method
 # efficiently builds the feed cache after the initial sync.
 def rebuild_feed_cache(truncate=True):
@@ -392,14 +465,183 @@ def select_missing_posts(limit=None, fast_mode=True):
     return list(query(sql))
 
 
+# payout schedule
+# ---------------
+# min-heap of (payout_at, post_id) over unpaid cached posts, loaded from
+# the db on first use. once cache rows are committed, schedule_payouts
+# applies their payout times. when a post's payout_at changes a new entry
+# is pushed; outdated entries are dropped as they surface.
+_payout_heap = None
+_payout_at = {}  # post_id -> payout_at, for unpaid posts
+
+
+def _as_time(value):
+    return value if isinstance(value, datetime) else parse_time(value)
+
+
+def load_payouts():
+    global _payout_heap, _payout_at
+    rows = query_all("SELECT payout_at, post_id FROM hive_posts_cache "
+                     "WHERE is_paidout = 0")
+    _payout_heap = [(payout_at, pid) for payout_at, pid in rows]
+    heapq.heapify(_payout_heap)
+    _payout_at = {pid: payout_at for payout_at, pid in _payout_heap}
+
+
+def schedule_payout(pid, payout_at, is_paidout):
+    if _payout_heap is None:
+        return  # not loaded yet; will be read from the db
+    if is_paidout:
+        _payout_at.pop(pid, None)
+        return
+    payout_at = _as_time(payout_at)
+    if _payout_at.get(pid) != payout_at:
+        _payout_at[pid] = payout_at
+        heapq.heappush(_payout_heap, (payout_at, pid))
+
+
+def schedule_payouts(batches):
+    """ Apply the payout times of committed generate_cached_post_sql
+    queries. """
+    for queries in batches:
+        for (_, params) in queries:
+            if 'payout_at' in params and 'is_paidout' in params:
+                schedule_payout(int(params['post_id']), params['payout_at'],
+                                int(params['is_paidout']))
+
+
 # when a post gets paidout ensure we update its final state
 def select_paidout_posts(block_date):
+    """ Posts due to pay out by `block_date`. They stay scheduled until
+    their refresh is committed (see schedule_payouts). """
+    if _payout_heap is None:
+        load_payouts()
+
+    date = _as_time(block_date)
+    due = []
+    while _payout_heap and _payout_heap[0][0] <= date:
+        payout_at, pid = heapq.heappop(_payout_heap)
+        if _payout_at.get(pid) == payout_at:
+            due.append((payout_at, pid))
+    for entry in due:
+        heapq.heappush(_payout_heap, entry)
+    if not due:
+        return []
+
+    sql = ("SELECT id, author, permlink FROM hive_posts "
+           "WHERE id IN :ids AND is_deleted = 0")
+    rows = list(query(sql, ids=tuple(pid for _, pid in due)))
+
+    # deleted posts are no longer cached, so never pay out here
+    found = set(row[0] for row in rows)
+    for _, pid in due:
+        if pid not in found:
+            del _payout_at[pid]
+    return rows
+
+
+# refresh queue
+# -------------
+# with deferred caching, block processing only records which posts changed
+# in hive_dirty_posts, and `hive indexer cache-worker` refreshes them (and
+# handles payouts). posts paying out within PAYOUT_SOON go first, soonest
+# first, then the most recently active.
+
+PAYOUT_SOON = timedelta(hours=1)
+PAYOUT_RELOAD_SECS = 60
+
+
+def queue_posts(ids, touched_at):
+    """ Queue posts for refresh, in the caller's transaction. """
+    ids = list(ids)
+    # uncached posts pay out 7 days after creation; paid out posts never
     sql = """
-    SELECT post_id, author, permlink FROM hive_posts_cache
-    WHERE post_id IN (SELECT post_id FROM hive_posts_cache
-    WHERE is_paidout = 0 AND payout_at <= :date)
+    INSERT INTO hive_dirty_posts (post_id, payout_at, touched_at)
+    SELECT p.id, CASE WHEN c.post_id IS NULL THEN p.created_at + INTERVAL 7 DAY
+                      WHEN c.is_paidout = 0 THEN c.payout_at
+                      ELSE '9999-12-31' END, :date
+      FROM hive_posts p LEFT JOIN hive_posts_cache c ON c.post_id = p.id
+     WHERE p.id IN :ids
+    ON DUPLICATE KEY UPDATE payout_at = VALUES(payout_at),
+                            touched_at = GREATEST(touched_at, VALUES(touched_at))
     """
-    return list(query(sql, date=block_date))
+    for i in range(0, len(ids), 1000):
+        query(sql, ids=tuple(ids[i:i+1000]), date=touched_at)
+
+
+def queue_missing_posts():
+    sql = ("INSERT IGNORE INTO hive_dirty_posts (post_id, payout_at, touched_at) "
+           "SELECT id, created_at + INTERVAL 7 DAY, created_at FROM hive_posts "
+           "WHERE is_deleted = 0 AND id > (SELECT IFNULL(MAX(post_id), 0) FROM hive_posts_cache)")
+    query(sql)
+
+
+def select_queued_posts(limit, date):
+    """ Up to `limit` queued posts, most urgent first, as
+    (id, author, permlink, is_deleted, touched_at). """
+    sql = ("SELECT q.post_id, p.author, p.permlink, p.is_deleted, q.touched_at "
+           "FROM hive_dirty_posts q JOIN hive_posts p ON p.id = q.post_id "
+           "WHERE %s LIMIT %d")
+    soon = date + PAYOUT_SOON
+    rows = query_all(sql % ("q.payout_at <= :soon ORDER BY q.payout_at", limit), soon=soon)
+    if len(rows) < limit:
+        rows += query_all(sql % ("q.payout_at > :soon ORDER BY q.touched_at DESC",
+                                 limit - len(rows)), soon=soon)
+    return rows
+
+
+def select_queued_at(ids):
+    """ (post_id, touched_at) of those of `ids` which are queued. """
+    if not ids:
+        return []
+    sql = "SELECT post_id, touched_at FROM hive_dirty_posts WHERE post_id IN :ids"
+    return query_all(sql, ids=tuple(ids))
+
+
+def unqueue_posts(pairs):
+    """ Dequeue (post_id, touched_at) pairs as read. Posts touched again
+    since stay queued. """
+    for i in range(0, len(pairs), 1000):
+        params = {}
+        vals = []
+        for j, (pid, touched_at) in enumerate(pairs[i:i+1000]):
+            vals.append("(:id%d, :at%d)" % (j, j))
+            params.update({'id%d' % j: pid, 'at%d' % j: touched_at})
+        query("DELETE FROM hive_dirty_posts WHERE (post_id, touched_at) IN (%s)"
+              % ','.join(vals), **params)
+
+
+def run_cache_worker(batch_size=1000, idle_secs=3):
+    """ Drain the refresh queue and process payouts, forever. """
+    steemd = get_adapter()
+    print("[CACHE] Worker started with {} posts queued".format(
+        query_one("SELECT COUNT(*) FROM hive_dirty_posts")))
+    loaded_at = 0
+
+    while True:
+        lap_0 = time.time()
+        # the indexer also writes cache rows (e.g. when popping a fork)
+        if lap_0 - loaded_at > PAYOUT_RELOAD_SECS:
+            load_payouts()
+            loaded_at = lap_0
+        date = steemd.head_time()
+        paidout = select_paidout_posts(date)
+        queued = select_queued_at([pid for pid, _, _ in paidout])
+        update_posts_batch(paidout, steemd, date)
+        unqueue_posts(queued)
+
+        rows = select_queued_posts(batch_size, parse_time(date))
+        update_posts_batch([(pid, author, permlink)
+                            for pid, author, permlink, is_deleted, _ in rows
+                            if not is_deleted], steemd, date)
+        unqueue_posts([(row[0], row[4]) for row in rows])
+
+        if not rows and not paidout:
+            time.sleep(idle_secs)
+            continue
+        print("[CACHE] Refreshed {} posts and {} payouts in {}s, {} queued".format(
+            len(rows), len(paidout), round(time.time() - lap_0, 2),
+            query_one("SELECT COUNT(*) FROM hive_dirty_posts")))
 
 
 # remove any rows from cache which belong to a deleted post
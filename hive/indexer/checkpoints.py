@@ -0,0 +1,457 @@
+import bz2
+import glob
+import gzip
+import json
+import lzma
+import multiprocessing
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# the only ops `process_block` looks at; everything else is dropped by the
+# decode workers so the writer (and the pipe back to it) never sees it.
+RELEVANT_OPS = {'pow', 'pow2', 'account_create', 'account_create_with_delegation',
+                'comment', 'delete_comment', 'vote', 'custom_json'}
+RELEVANT_JSON_IDS = {'follow', 'com.steemit.community'}
+
+CHECKPOINTS_DIR = os.path.dirname(os.path.realpath(__file__ + "/../..")) + "/checkpoints"
+
+
+def is_relevant_op(op_type, op):
+    if op_type not in RELEVANT_OPS:
+        return False
+    if op_type == 'custom_json':
+        return op['id'] in RELEVANT_JSON_IDS
+    return True
+
+
+def filter_block(block):
+    """ Strip a block down to its header and the ops hive processes.
+
+    Transactions are kept (possibly empty) since their count is stored. """
+    return {
+        'block_id': block['block_id'],
+        'previous': block['previous'],
+        'timestamp': block['timestamp'],
+        'transactions': [{'operations': [[op_type, op] for op_type, op in tx['operations']
+                                         if is_relevant_op(op_type, op)]}
+                         for tx in block['transactions']]}
+
+
+def _decode_chunk(lines):
+    start = time.time()
+    blocks = [filter_block(json.loads(line.decode('utf-8'))) for line in lines]
+    return blocks, time.time() - start
+
+
+# sidecar index
+# -------------
+# `(file).idx` maps every INDEX_STEP'th line (block) of a checkpoint file to
+# its byte offset, so resuming seeks straight to the first needed block. it
+# is only trusted if size and mtime still match the checkpoint file.
+INDEX_STEP = 10000
+
+
+def _file_sig(file_path):
+    stat = os.stat(file_path)
+    return stat.st_size, int(stat.st_mtime)
+
+
+def load_index(file_path):
+    try:
+        with open(file_path + '.idx') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if [index.get('size'), index.get('mtime')] != list(_file_sig(file_path)):
+        print("[SYNC] Ignoring stale index for {}".format(file_path))
+        return None
+    return index['offsets']
+
+
+def save_index(file_path, offsets):
+    size, mtime = _file_sig(file_path)
+    index = {'size': size, 'mtime': mtime, 'step': INDEX_STEP, 'offsets': offsets}
+    try:
+        with open(file_path + '.idx.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(file_path + '.idx.tmp', file_path + '.idx')
+    except OSError as e:
+        print("[SYNC] Could not write index for {}: {}".format(file_path, e))
+
+
+def build_index(file_path):
+    print("[SYNC] Building index for {}".format(file_path))
+    compact = _is_compact(file_path)
+    offsets = []
+    offset = _data_offset(file_path)
+    with open(file_path, 'rb') as f:
+        f.seek(offset)
+        for line_no, size in enumerate(_record_sizes(f) if compact else map(len, f)):
+            if line_no % INDEX_STEP == 0:
+                offsets.append([line_no, offset])
+            offset += size
+    save_index(file_path, offsets)
+    return offsets
+
+
+# compact files
+# -------------
+# `(block_num).compact` holds the same blocks as a `.json.lst`, minus every
+# op hive ignores (see `filter_block`), as length-prefixed records: a magic
+# header, then per block a 4-byte big-endian length and the compact json.
+COMPACT_EXT = '.compact'
+COMPACT_MAGIC = b'HIVEBLK\x01'
+
+
+def _is_compact(file_path):
+    return file_path.endswith(COMPACT_EXT)
+
+
+def _data_offset(file_path):
+    return len(COMPACT_MAGIC) if _is_compact(file_path) else 0
+
+
+def _read_head(f):
+    """ Payload size of the next record, or None at the end of the file. """
+    head = f.read(4)
+    if not head:
+        return None
+    if len(head) < 4:
+        raise ValueError("truncated record header at byte {}".format(
+            f.tell() - len(head)))
+    return struct.unpack('>I', head)[0]
+
+
+def _record_sizes(f):
+    """ Yield on-disk record sizes, seeking past each payload. """
+    end = os.fstat(f.fileno()).st_size
+    while True:
+        size = _read_head(f)
+        if size is None:
+            return
+        if f.seek(size, 1) > end:
+            raise ValueError("truncated record at byte {}".format(f.tell() - size - 4))
+        yield 4 + size
+
+
+def _records(f):
+    """ Yield (payload, on-disk size) for each record. A file which ends
+    inside a record (e.g. an interrupted convert) raises ValueError rather
+    than silently ending the sync short. """
+    while True:
+        size = _read_head(f)
+        if size is None:
+            return
+        data = f.read(size)
+        if len(data) < size:
+            raise ValueError("truncated record at byte {}".format(
+                f.tell() - len(data) - 4))
+        yield data, 4 + size
+
+
+def _write_compact(file_path, out_path):
+    offsets = []
+    with open(out_path, 'wb') as out:
+        out.write(COMPACT_MAGIC)
+        for line_no, line in enumerate(_iter_lines(file_path)):
+            if line_no % INDEX_STEP == 0:
+                offsets.append([line_no, out.tell()])
+            block = filter_block(json.loads(line.decode('utf-8')))
+            data = json.dumps(block, separators=(',', ':')).encode('utf-8')
+            out.write(struct.pack('>I', len(data)) + data)
+    save_index(out_path, offsets or [[0, len(COMPACT_MAGIC)]])
+    print("[SYNC] Wrote {} ({} -> {} bytes)".format(
+        out_path, os.path.getsize(file_path), os.path.getsize(out_path)))
+    return out_path
+
+
+# compressed files
+# ----------------
+# `.json.lst.gz|bz2|xz` checkpoints are decompressed as a stream. files made
+# by `convert_checkpoint` are block-framed: every INDEX_STEP lines start a
+# new, independent compressed stream, and the index records where each one
+# begins, so a resume can seek to a frame boundary and decompress from there.
+CODECS = {
+    '.gz': (lambda raw: gzip.GzipFile(fileobj=raw), lambda: zlib.compressobj(9, zlib.DEFLATED, 31)),
+    '.bz2': (bz2.BZ2File, bz2.BZ2Compressor),
+    '.xz': (lzma.LZMAFile, lambda: lzma.LZMACompressor(lzma.FORMAT_XZ)),
+}
+
+
+def _codec(file_path):
+    return CODECS.get(os.path.splitext(file_path)[1])
+
+
+def list_files(path):
+    """ Returns sorted [num, path] for checkpoint files in a directory.
+
+    If a range exists in several formats, the compact file wins, then the
+    uncompressed one. """
+    files = {}
+    patterns = ["/*.json.lst.xz", "/*.json.lst.bz2", "/*.json.lst.gz",
+                "/*.json.lst", "/*" + COMPACT_EXT]
+    for pattern in patterns:
+        for file_path in glob.glob(path + pattern):
+            files[int(file_path.split('/')[-1].split('.')[0])] = file_path
+    return sorted(files.items())
+
+
+def _iter_lines(file_path):
+    codec = _codec(file_path)
+    with open(file_path, 'rb') as raw:
+        yield from (codec[0](raw) if codec else raw)
+
+
+def convert_checkpoint(file_path, ext):
+    """ Write a block-framed compressed, or a compact, copy of a checkpoint.
+
+    Raises ValueError for an unknown format, a compact source, or an
+    existing output file. """
+    if ext not in CODECS and ext != COMPACT_EXT:
+        raise ValueError("unknown format {}".format(ext))
+    if _is_compact(file_path):
+        raise ValueError("cannot convert from compact format")
+    base = file_path.split('.json.lst')[0]
+    out_path = base + (ext if ext == COMPACT_EXT else '.json.lst' + ext)
+    if os.path.exists(out_path):
+        raise ValueError("{} already exists".format(out_path))
+    if ext == COMPACT_EXT:
+        return _write_compact(file_path, out_path)
+    compressor_factory = CODECS[ext][1]
+
+    offsets = []
+    with open(out_path, 'wb') as out:
+        compressor = None
+        for line_no, line in enumerate(_iter_lines(file_path)):
+            if line_no % INDEX_STEP == 0:
+                if compressor:
+                    out.write(compressor.flush())
+                offsets.append([line_no, out.tell()])
+                compressor = compressor_factory()
+            out.write(compressor.compress(line))
+        if compressor:
+            out.write(compressor.flush())
+    save_index(out_path, offsets or [[0, 0]])
+    print("[SYNC] Wrote {} ({} frames)".format(out_path, len(offsets)))
+    return out_path
+
+
+def _read_chunks(file_path, skip_lines, chunk_size):
+    codec = _codec(file_path)
+    compact = _is_compact(file_path)
+    offsets = load_index(file_path)
+    if offsets is None and codec:
+        if skip_lines:
+            print("[SYNC] No frame index for {}; decompressing from "
+                  "the start".format(file_path))
+        offsets = [[0, 0]]
+    elif offsets is None:
+        offsets = (build_index(file_path) if skip_lines
+                   else [[0, _data_offset(file_path)]])
+    known = len(offsets)
+
+    # each line in file represents one block. seek to the closest indexed
+    # line before the resume point, and skip the few blocks we already have
+    line_no, offset = [entry for entry in offsets if entry[0] <= skip_lines][-1]
+    try:
+        with open(file_path, 'rb') as raw:
+            if compact and raw.read(len(COMPACT_MAGIC)) != COMPACT_MAGIC:
+                raise ValueError("{} is not a compact checkpoint".format(file_path))
+            raw.seek(offset)
+            f = codec[0](raw) if codec else raw
+            records = _records(f) if compact else ((line, len(line)) for line in f)
+            batch = []
+            for line, size in records:
+                if (not codec and line_no % INDEX_STEP == 0
+                        and line_no > offsets[-1][0]):
+                    offsets.append([line_no, offset])
+                offset += size
+                line_no += 1
+                if line_no <= skip_lines:
+                    continue
+                batch.append(line)
+                if len(batch) == chunk_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+    finally:
+        # offsets seen on the way are kept even if the sync is interrupted
+        if len(offsets) > known:
+            save_index(file_path, offsets)
+
+
+class PipelineStats:
+    """ Throughput counters for each stage of the checkpoint pipeline. """
+
+    def __init__(self):
+        self.start = time.time()
+        self.blocks = 0
+        self.read_secs = 0.0    # reader: time spent pulling lines from disk
+        self.decode_secs = 0.0  # workers: summed cpu time in json.loads
+        self.write_secs = 0.0   # writer: time spent in the consumer
+        self.wait_secs = 0.0    # writer: time starved waiting on decoders
+
+    def report(self, workers):
+        def rate(secs):
+            return int(self.blocks / secs) if secs else 0
+        elapsed = time.time() - self.start
+        print("[SYNC] {} blocks ({}/s) -- read {}/s, decode {}/s x{} workers, "
+              "write {}/s, writer idle {}%".format(
+                  self.blocks, rate(elapsed), rate(self.read_secs),
+                  rate(self.decode_secs), workers, rate(self.write_secs),
+                  int(100 * self.wait_secs / elapsed) if elapsed else 0))
+
+
+def read_blocks(file_path, skip_lines=0, chunk_size=250, workers=None,
+                queue_depth=8, report_every=40):
+    """ Stream decoded blocks from a checkpoint file, one chunk at a time.
+
+    A reader thread streams lines and hands each chunk to a pool of worker
+    processes for decoding. Pending chunks wait in a queue bounded by
+    `queue_depth` and are yielded strictly in file order, so the single db
+    writer consuming this generator overlaps with reading and decoding.
+    """
+    workers = workers or max(1, (os.cpu_count() or 2) - 1)
+    stats = PipelineStats()
+    pending = queue.Queue(maxsize=queue_depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # blocks while the queue is full, unless the writer has gone away
+        while not stop.is_set():
+            try:
+                pending.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def reader(pool):
+        chunks = _read_chunks(file_path, skip_lines, chunk_size)
+        try:
+            while not stop.is_set():
+                lap = time.time()
+                chunk = next(chunks, None)
+                stats.read_secs += time.time() - lap
+                if chunk is None:
+                    break
+                put(pool.apply_async(_decode_chunk, (chunk,)))
+        except Exception as e:  # surface reader errors to the writer
+            put(e)
+        finally:
+            chunks.close()
+        put(done)
+
+    with multiprocessing.Pool(workers) as pool:
+        thread = threading.Thread(target=reader, args=(pool,), daemon=True)
+        thread.start()
+        try:
+            count = 0
+            while True:
+                lap = time.time()
+                result = pending.get()
+                if result is done:
+                    break
+                if isinstance(result, Exception):
+                    raise result
+                blocks, decode_secs = result.get()
+                stats.wait_secs += time.time() - lap
+                stats.decode_secs += decode_secs
+
+                lap = time.time()
+                yield blocks
+                stats.write_secs += time.time() - lap
+                stats.blocks += len(blocks)
+
+                count += 1
+                if count % report_every == 0:
+                    stats.report(workers)
+        finally:
+            stop.set()
+            thread.join()
+    if stats.blocks:
+        stats.report(workers)
+
+
+# exporter
+# --------
+def _count_lines(file_path, limit=None):
+    """ Count complete lines, truncating a torn trailing line if any, and
+    any lines past `limit`. """
+    count = 0
+    offset = 0
+    with open(file_path, 'rb+') as f:
+        for line in f:
+            if not line.endswith(b'\n') or count == limit:
+                break
+            count += 1
+            offset += len(line)
+        f.truncate(offset)
+    return count
+
+
+def _fetch_ranges(steemd, lbound, ubound, batch, parallel):
+    """ Yield blocks [lbound, ubound) in order, fetching ranges in parallel. """
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        pending = deque()
+        nums = iter(range(lbound, ubound, batch))
+        while True:
+            while len(pending) < parallel * 2:
+                start = next(nums, None)
+                if start is None:
+                    break
+                end = min(start + batch, ubound)
+                pending.append(executor.submit(steemd.get_blocks_range, start, end))
+            if not pending:
+                break
+            yield from pending.popleft().result()
+
+
+def dump_checkpoints(steemd, lbound, ubound, path=CHECKPOINTS_DIR,
+                     file_blocks=1000000, batch=1000, parallel=4):
+    """ Export blocks [lbound, ubound] into `(block_num).json.lst` files.
+
+    Files end on multiples of `file_blocks` (the last one at `ubound`). They
+    are written as `from-(first block).json.lst.part` in the output
+    directory and renamed when complete. A later run starting at the same
+    block resumes an existing `.part` from its last complete line, whatever
+    its `ubound`.
+    """
+    if lbound < 1:
+        raise ValueError("first block must be at least 1, not {}".format(lbound))
+    if file_blocks < 1:
+        raise ValueError("file_blocks must be positive, not {}".format(file_blocks))
+    start = lbound
+    while start <= ubound:
+        end = min((start - 1) // file_blocks * file_blocks + file_blocks, ubound)
+        out_path = "{}/{}.json.lst".format(path, end)
+        part_path = "{}/from-{}.json.lst.part".format(path, start)
+        if os.path.exists(out_path):
+            raise FileExistsError("{} already exists".format(out_path))
+
+        have = (_count_lines(part_path, limit=end - start + 1)
+                if os.path.exists(part_path) else 0)
+        print("[DUMP] Writing blocks {}-{} to {} (resuming at {})".format(
+            start, end, out_path, start + have))
+
+        lap_0 = time.time()
+        count = 0
+        with open(part_path, 'a') as f:
+            for block in _fetch_ranges(steemd, start + have, end + 1, batch, parallel):
+                f.write(json.dumps(block) + "\n")
+                count += 1
+                if count % 10000 == 0:
+                    rate = count / (time.time() - lap_0)
+                    print("[DUMP] Got block {} ({}/s) -- {}m remaining".format(
+                        start + have + count - 1, round(rate, 1),
+                        round((ubound - start - have - count) / rate / 60, 2)))
+        os.rename(part_path, out_path)
+        start = end + 1
@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 import click
 from click import echo
-from hive.indexer.core import run, head_state
+from hive.indexer.core import run, head_state, VOTE_WINDOW_BLOCKS, VOTE_WINDOW_SECS
+from hive.indexer.cache import run_cache_worker
+from hive.indexer.checkpoints import convert_checkpoint, dump_checkpoints, list_files, CHECKPOINTS_DIR
+from hive.indexer.utils import get_adapter
 from hive.db.schema import setup
 from prettytable import PrettyTable
 
@@ -16,10 +19,26 @@ def indexer():
 
 
 @indexer.command(name='run')
-def index_from_steemd():
+@click.option('--trail-blocks', type=click.INT, default=0,
+              help='stay this many blocks behind head (forks are undone either way)')
+@click.option('--vote-window-blocks', type=click.INT, default=VOTE_WINDOW_BLOCKS,
+              help='refresh posts which were only voted on every this many blocks')
+@click.option('--vote-window-secs', type=click.FLOAT, default=VOTE_WINDOW_SECS,
+              help='... or every this many seconds, whichever comes first')
+@click.option('--defer-cache', is_flag=True, default=False,
+              help='queue post refreshes and payouts for `cache-worker`')
+def index_from_steemd(trail_blocks, vote_window_blocks, vote_window_secs, defer_cache):
     """sync up to head block, then listen"""
     echo('Starting hivemind...')
-    run()
+    run(trail_blocks, vote_window_blocks, vote_window_secs, defer_cache)
+
+
+@indexer.command(name='cache-worker')
+@click.option('--batch-size', type=click.INT, default=1000,
+              help='posts refreshed per round')
+def cache_worker(batch_size):
+    """refresh posts queued by `run --defer-cache`"""
+    run_cache_worker(batch_size)
 
 
 @indexer.command(name='show-status')
@@ -30,3 +49,44 @@ def show_status():
     s = head_state()
     t.add_row([s['steemd'], s['hive'], s['diff']])
     echo(t)
+
+
+@indexer.command(name='convert-checkpoint')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    '--format',
+    'fmt',
+    type=click.Choice(['gz', 'bz2', 'xz', 'compact']),
+    default='gz',
+    help='compression codec for the block-framed copy, or compact '
+         '(relevant ops only)')
+def convert_checkpoint_command(path, fmt):
+    """write a compressed or compact copy of a checkpoint file"""
+    try:
+        convert_checkpoint(path, '.' + fmt)
+    except ValueError as e:
+        raise click.UsageError(str(e))
+
+
+@indexer.command(name='dump-checkpoints')
+@click.option('--from', 'lbound', type=click.IntRange(min=1), default=None,
+              help='first block (default: after the last checkpoint file)')
+@click.option('--to', 'ubound', type=click.INT, default=None,
+              help='last block (default: last irreversible block)')
+@click.option('--file-blocks', type=click.IntRange(min=1), default=1000000,
+              help='blocks per checkpoint file')
+@click.option('--parallel', type=click.IntRange(min=1), default=4,
+              help='number of block ranges fetched concurrently')
+def dump_checkpoints_command(lbound, ubound, file_blocks, parallel):
+    """export blocks from steemd into checkpoint files"""
+    steemd = get_adapter()
+    if lbound is None:
+        files = list_files(CHECKPOINTS_DIR)
+        lbound = files[-1][0] + 1 if files else 1
+    if ubound is None:
+        ubound = steemd.last_irreversible_block_num()
+    try:
+        dump_checkpoints(steemd, lbound, ubound, file_blocks=file_blocks,
+                         parallel=parallel)
+    except FileExistsError as e:
+        raise click.UsageError(str(e))
@@ -1,5 +1,6 @@
 from funcy.seqs import first, flatten
 from hive.db.methods import query_row
+from hive.indexer.accounts import get_id as get_account_id
 from hive.community.roles import get_user_role, privacy_map, permissions, is_permitted
 
 # community methods
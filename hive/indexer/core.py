@@ -1,50 +1,59 @@
 import json
 import logging
-import glob
+import queue
+import threading
 import time
-import re
-import os
 
+from datetime import datetime, timedelta
 from json import JSONDecodeError
-from funcy.seqs import first, second, drop, flatten
-from hive.db.schema import setup, teardown
-from hive.db.methods import query_one, query, query_row, db_last_block
-from toolz import partition_all
-
-from hive.indexer.utils import get_adapter
+from funcy.seqs import first, second, flatten
+from hive.db.schema import setup, teardown, upgrade
+from hive.db.methods import query_one, query, query_row, query_all, db_last_block
+
+from hive.indexer.utils import get_adapter, parse_time
+from hive.indexer.checkpoints import read_blocks, CHECKPOINTS_DIR, list_files as list_checkpoints
+from hive.indexer.accounts import is_valid_account_name
+from hive.indexer import accounts, posts, follow, undo
 from hive.indexer.cache import select_missing_posts, rebuild_feed_cache, select_paidout_posts, update_posts_batch
+from hive.indexer.cache import fetch_posts, cached_posts_sql, write_queries
+from hive.indexer.cache import queue_posts, queue_missing_posts, vote_updates_sql
+from hive.indexer.cache import schedule_payouts, load_payouts
 from hive.indexer.community import process_json_community_op, is_community_post_valid
 
 log = logging.getLogger(__name__)
 
-# core
-# ----
-def is_valid_account_name(name):
-    return re.match('^[a-z][a-z0-9\-.]{2,15}$', name)
+BLOCK_INTERVAL = 3
+BLOCK_PROPAGATION = 0.25  # typical delay between a block's slot and it being served
 
+# in live mode, fall back to batch sync when this many blocks behind head.
+# must stay well above the usual head-to-irreversible gap, which batch
+# sync cannot close.
+CATCHUP_BLOCKS = 100
 
-def get_account_id(name):
-    if is_valid_account_name(name):
-        return query_one("SELECT id FROM hive_accounts "
-                "WHERE name = :n LIMIT 1", n=name)
-
+# in live mode, posts which were only voted on are refreshed together once
+# this many blocks or seconds have passed; new posts and edits refresh at once
+VOTE_WINDOW_BLOCKS = 10
+VOTE_WINDOW_SECS = 30
 
+# core
+# ----
 def get_post_id_and_depth(author, permlink):
     res = None
     if author:
-        res = query_row("SELECT id, depth FROM hive_posts WHERE "
-                "author = :a AND permlink = :p", a=author, p=permlink)
-    return res or (None, -1)
+        res = posts.get(author, permlink)
+    return res[0:2] if res else (None, -1)
 
 
-def urls_to_tuples(urls):
+def urls_to_tuples(urls, skip_missing=False):
+    keys = [tuple(url.split('/')) for url in urls]
+    rows = posts.get_many(keys)
     tuples = []
-    for url in urls:
-        author, permlink = url.split('/')
-        pid, is_deleted = query_row("SELECT id,is_deleted FROM hive_posts "
-                "WHERE author = :a AND permlink = :p", a=author, p=permlink)
-        if not pid:
+    for author, permlink in keys:
+        if (author, permlink) not in rows:
+            if skip_missing:
+                continue
             raise Exception("Post not found! {}/{}".format(author, permlink))
+        pid, _, _, _, is_deleted = rows[(author, permlink)]
         if is_deleted:
             continue
         tuples.append([pid, author, permlink])
@@ -69,17 +78,20 @@ def get_op_community(comment):
 # --------------------
 
 # register any new accounts in a block
-def register_accounts(accounts, date):
-    for account in set(accounts):
-        if not get_account_id(account):
-            query("INSERT INTO hive_accounts (name, created_at) "
-                    "VALUES (:name, :date)", name=account, date=date)
+def register_accounts(names, date):
+    accounts.register(names, date)
 
 
 # marks posts as deleted and removes them from feed cache
 def delete_posts(ops):
     for op in ops:
         post_id, depth = get_post_id_and_depth(op['author'], op['permlink'])
+        if posts.is_pending(post_id) or follow.has_reblogs(post_id):
+            flush_blocks()
+        posts.set_deleted(op['author'], op['permlink'])
+        undo.snapshot('hive_posts', 'id = :id', id=post_id)
+        undo.snapshot('hive_feed_cache', 'post_id = :id', id=post_id)
+        undo.recache([post_id])
         query("UPDATE hive_posts SET is_deleted = 1 WHERE id = :id", id=post_id)
         query("DELETE FROM hive_posts_cache WHERE post_id = :id", id=post_id)
         query("DELETE FROM hive_feed_cache WHERE post_id = :id", id=post_id)
@@ -88,14 +100,12 @@ def delete_posts(ops):
 # registers new posts (not edits), inserts into feed cache
 def register_posts(ops, date):
     for op in ops:
-        sql = ("SELECT id, is_deleted FROM hive_posts "
-            "WHERE author = :a AND permlink = :p")
-        ret = query_row(sql, a=op['author'], p=op['permlink'])
+        ret = posts.get(op['author'], op['permlink'])
         pid = None
         if not ret:
             # post does not exist, go ahead and process it
             pass
-        elif ret[1] == 0:
+        elif ret[4] == 0:
             # post exists and is not deleted, thus it's an edit. ignore.
             continue
         else:
@@ -109,13 +119,12 @@ def register_posts(ops, date):
             category = op['parent_permlink']
             community = get_op_community(op) or op['author']
         else:
-            parent_data = query_row("SELECT id, depth, category, community FROM hive_posts WHERE author = :a "
-                                      "AND permlink = :p", a=op['parent_author'], p=op['parent_permlink'])
-            parent_id, parent_depth, category, community = parent_data
+            parent_data = posts.get(op['parent_author'], op['parent_permlink'])
+            parent_id, parent_depth, category, community, _ = parent_data
             depth = parent_depth + 1
 
         # community must be an existing account
-        if not get_account_id(community):
+        if not accounts.exists(community):
             print("Invalid community @{}/{} -- {}".format(op['author'], op['permlink'], community))
             community = op['author']
 
@@ -127,28 +136,22 @@ def register_posts(ops, date):
 
         # if we're reusing a previously-deleted post (rare!), update it
         if pid:
+            if posts.is_pending(pid) or accounts.is_pending(community):
+                flush_blocks()
+            undo.snapshot('hive_posts', 'id = :id', id=pid)
+            undo.snapshot('hive_feed_cache', 'post_id = :id', id=pid)
             query("UPDATE hive_posts SET is_valid = :is_valid, is_deleted = 0, parent_id = :parent_id, category = :category, community = :community, depth = :depth WHERE id = :id",
                   is_valid=is_valid, parent_id=parent_id, category=category, community=community, depth=depth, id=pid)
             query("DELETE FROM hive_feed_cache WHERE account = :account AND post_id = :id", account=op['author'], id=pid)
+            posts.put(op['author'], op['permlink'], pid, depth, category, community)
         else:
-            sql = """
-            INSERT INTO hive_posts (is_valid, parent_id, author, permlink,
-                                    category, community, depth, created_at)
-            VALUES (:is_valid, :parent_id, :author, :permlink,
-                    :category, :community, :depth, :date)
-            """
-            query(sql, is_valid=is_valid, parent_id=parent_id,
-                  author=op['author'], permlink=op['permlink'],
-                  category=category, community=community,
-                  depth=depth, date=date)
-
-            pid = query_one("SELECT id FROM hive_posts WHERE author = :a AND "
-                            "permlink = :p", a=op['author'], p=op['permlink'])
+            # id is allocated up front; row is written when the batch flushes
+            pid = posts.next_id()
+            posts.insert(pid, op, parent_id, category, community, depth, is_valid, date)
 
         # add top-level posts to feed cache
         if depth == 0:
-            sql = "INSERT INTO hive_feed_cache (account, post_id, created_at) VALUES (:account, :id, :created_at)"
-            query(sql, account=op['author'], id=pid, created_at=date)
+            posts.insert_feed(op['author'], pid, date)
 
 
 
@@ -182,12 +185,8 @@ def process_json_follow_op(account, op_json, block_date):
         if not all(filter(is_valid_account_name, [follower, following])):
             return  # invalid input
 
-        sql = """
-        INSERT IGNORE INTO hive_follows (follower, following, created_at, state)
-        VALUES (:fr, :fg, :at, :state) ON DUPLICATE KEY UPDATE state = :state
-        """
         state = {'clear': 0, 'blog': 1, 'ignore': 2}[what]
-        query(sql, fr=follower, fg=following, at=block_date, state=state)
+        follow.follow(follower, following, state, block_date)
 
     elif cmd == 'reblog':
         blogger = op_json['account']
@@ -209,14 +208,9 @@ def process_json_follow_op(account, op_json, block_date):
             return
 
         if 'delete' in op_json and op_json['delete'] == 'delete':
-            query("DELETE FROM hive_reblogs WHERE account = :a AND post_id = :pid LIMIT 1", a=blogger, pid=post_id)
-            sql = "DELETE FROM hive_feed_cache WHERE account = :account AND post_id = :id"
-            query(sql, account=blogger, id=post_id)
+            follow.unreblog(blogger, post_id)
         else:
-            query("INSERT IGNORE INTO hive_reblogs (account, post_id, created_at) "
-                  "VALUES (:a, :pid, :date)", a=blogger, pid=post_id, date=block_date)
-            sql = "INSERT IGNORE INTO hive_feed_cache (account, post_id, created_at) VALUES (:account, :id, :created_at)"
-            query(sql, account=blogger, id=post_id, created_at=block_date)
+            follow.reblog(blogger, post_id, block_date)
 
 
 # process a single block. always wrap in a transaction!
@@ -227,11 +221,12 @@ def process_block(block, is_initial_sync=False):
     block_num = int(block_id[:8], base=16)
     txs = block['transactions']
 
+    undo.snapshot('hive_blocks', 'num = :num', num=block_num)
     query("INSERT INTO hive_blocks (num, hash, prev, txs, created_at) "
           "VALUES (:num, :hash, :prev, :txs, :date)",
           num=block_num, hash=block_id, prev=prev, txs=len(txs), date=date)
 
-    accounts = set()
+    new_accounts = set()
     comments = []
     json_ops = []
     deleted = []
@@ -241,11 +236,11 @@ def process_block(block, is_initial_sync=False):
             op_type, op = operation
 
             if op_type == 'pow':
-                accounts.add(op['worker_account'])
+                new_accounts.add(op['worker_account'])
             elif op_type == 'pow2':
-                accounts.add(op['work'][1]['input']['worker_account'])
+                new_accounts.add(op['work'][1]['input']['worker_account'])
             elif op_type in ['account_create', 'account_create_with_delegation']:
-                accounts.add(op['new_account_name'])
+                new_accounts.add(op['new_account_name'])
             elif op_type == 'comment':
                 comments.append(op)
                 dirty.add(op['author']+'/'+op['permlink'])
@@ -256,7 +251,7 @@ def process_block(block, is_initial_sync=False):
             elif op_type == 'vote':
                 dirty.add(op['author']+'/'+op['permlink'])
 
-    register_accounts(accounts, date)  # if an account does not exist, mark it as created in this block
+    register_accounts(new_accounts, date)  # if an account does not exist, mark it as created in this block
     register_posts(comments, date)  # if this is a new post, add the entry and validate community param
     delete_posts(deleted)  # mark hive_posts.is_deleted = 1
 
@@ -286,18 +281,59 @@ def process_block(block, is_initial_sync=False):
             process_json_follow_op(account, op_json, date)
         elif op['id'] == 'com.steemit.community':
             if block_num > 13e6:
+                accounts.flush()  # community ops write rows referencing accounts
                 process_json_community_op(account, op_json, date)
 
     # return all posts modified this block
     return dirty
 
 
+# urls of posts which a block's comment ops and vote ops modify
+def block_dirty_posts(block):
+    commented, voted = set(), set()
+    for tx in block['transactions']:
+        for op_type, op in tx['operations']:
+            if op_type == 'comment':
+                commented.add(op['author']+'/'+op['permlink'])
+            elif op_type == 'vote':
+                voted.add(op['author']+'/'+op['permlink'])
+    return commented, voted
+
+
+# write out any rows buffered while processing blocks
+def flush_blocks():
+    accounts.flush()
+    posts.flush()
+    follow.flush()
+
+
+# resolve every post and parent the batch's comment ops refer to, at once
+def prefetch_posts(blocks):
+    keys = set()
+    for block in blocks:
+        for tx in block['transactions']:
+            for op_type, op in tx['operations']:
+                if op_type == 'comment':
+                    keys.add((op['author'], op['permlink']))
+                    if op['parent_author']:
+                        keys.add((op['parent_author'], op['parent_permlink']))
+    posts.get_many(keys)
+
+
 # batch-process blocks, wrap in a transaction
-def process_blocks(blocks, is_initial_sync=False):
+def process_blocks(blocks, is_initial_sync=False, defer_cache=False):
+    """ Returns modified posts, or queues them for the cache worker. """
+    blocks = list(blocks)
+    prefetch_posts(blocks)
+
     dirty = set()
     query("START TRANSACTION")
     for block in blocks:
         dirty |= process_block(block, is_initial_sync)
+    flush_blocks()
+    if defer_cache:
+        queue_posts([pid for pid, _, _ in urls_to_tuples(dirty)], blocks[-1]['timestamp'])
+        dirty = set()
     query("COMMIT")
     return dirty
 
@@ -309,10 +345,7 @@ def process_blocks(blocks, is_initial_sync=False):
 def sync_from_checkpoints(is_initial_sync):
     last_block = db_last_block()
 
-    fn = lambda f: [int(f.split('/')[-1].split('.')[0]), f]
-    mydir = os.path.dirname(os.path.realpath(__file__ + "/../.."))
-    files = map(fn, glob.glob(mydir + "/checkpoints/*.json.lst"))
-    files = sorted(files, key=lambda f: f[0])
+    files = list_checkpoints(CHECKPOINTS_DIR)
 
     last_read = 0
     for (num, path) in files:
@@ -325,43 +358,86 @@ def sync_from_checkpoints(is_initial_sync):
 
 
 def sync_from_file(file_path, skip_lines, chunk_size=250, is_initial_sync=False):
-    with open(file_path) as f:
-        # each line in file represents one block
-        # we can skip the blocks we already have
-        remaining = drop(skip_lines, f)
-        for batch in partition_all(chunk_size, remaining):
-            process_blocks(map(json.loads, batch), is_initial_sync)
+    # blocks are read and decoded in a pipeline; only db writes happen here
+    for blocks in read_blocks(file_path, skip_lines, chunk_size):
+        process_blocks(blocks, is_initial_sync)
+
+
+def prefetch_blocks(steemd, lbound, ubound, depth=2):
+    """ Yield (lbound, to, blocks, fetch_secs) for ranges [lbound, ubound).
+
+    A background thread fetches up to `depth` ranges ahead of the consumer,
+    so the network is busy while the previous range is being written.
+    Range size follows the adapter's current `sync_window`. """
+    ranges = queue.Queue(maxsize=depth)
+    stop = threading.Event()
 
+    def put(item):
+        while not stop.is_set():
+            try:
+                ranges.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
 
-def sync_from_steemd(is_initial_sync):
+    def fetcher():
+        try:
+            start = lbound
+            while start < ubound and not stop.is_set():
+                to = min(start + steemd.sync_window(), ubound)
+                lap_0 = time.time()
+                blocks = steemd.get_blocks_range(start, to)
+                put((start, to, blocks, time.time() - lap_0))
+                start = to
+        except Exception as e:  # re-raised in the consumer
+            put(e)
+        put(None)
+
+    thread = threading.Thread(target=fetcher, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = ranges.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def sync_from_steemd(is_initial_sync, prefetch_depth=2, defer_cache=False):
     steemd = get_adapter()
     dirty = set()
 
-    lbound = db_last_block() + 1
+    # a reversible head left by listen mode may since have been forked out
+    lbound = pop_fork(steemd, defer_cache)[0] + 1
     ubound = steemd.last_irreversible_block_num()
 
     print("[SYNC] {} blocks to batch sync".format(ubound - lbound + 1))
     print("[SYNC] start sync from block %d" % lbound)
 
-    while lbound < ubound:
-        to = min(lbound + 1000, ubound)
-
-        lap_0 = time.time()
-        blocks = steemd.get_blocks_range(lbound, to)
+    lap_0 = time.time()
+    for start, to, blocks, fetch_secs in prefetch_blocks(
+            steemd, lbound, ubound, depth=prefetch_depth):
         lap_1 = time.time()
-        dirty |= process_blocks(blocks, is_initial_sync)
+        dirty |= process_blocks(blocks, is_initial_sync,
+                                defer_cache and not is_initial_sync)
         lap_2 = time.time()
 
-        rate = (to - lbound) / (lap_2 - lap_0)
-        rps = int((to - lbound) / (lap_1 - lap_0))
-        wps = int((to - lbound) / (lap_2 - lap_1))
-        print("[SYNC] Got block {} ({}/s, {}rps {}wps) -- {}m remaining".format(
-            to-1, round(rate, 1), rps, wps, round((ubound-to) / rate / 60, 2)))
-
-        lbound = to
+        # rps is the fetcher's own rate; `wait` is time the writer sat idle
+        # waiting on the network, which prefetching should drive toward 0
+        rate = (to - start) / (lap_2 - lap_0)
+        rps = int((to - start) / fetch_secs)
+        wps = int((to - start) / (lap_2 - lap_1))
+        print("[SYNC] Got block {} ({}/s, {}rps {}wps, wait {}s, {}) -- {}m remaining".format(
+            to-1, round(rate, 1), rps, wps, round(lap_1 - lap_0, 2),
+            steemd.fetch_settings(), round((ubound-to) / rate / 60, 2)))
+        lap_0 = time.time()
 
     # batch update post cache after catching up to head block
-    if not is_initial_sync:
+    if not is_initial_sync and not defer_cache:
 
         print("[PREP] Update {} edited posts".format(len(dirty)))
         update_posts_batch(urls_to_tuples(dirty), steemd)
@@ -372,56 +448,231 @@ def sync_from_steemd(is_initial_sync):
         update_posts_batch(paidout, steemd, date)
 
 
-def listen_steemd(trail_blocks=2):
+def steemd_block_id(steemd, num):
+    """ Id of block `num` on steemd's chain. A node which lags behind us
+    has no such block yet, which says nothing about forks: wait for it. """
+    block = steemd.get_block(num)
+    retry = 0.5
+    while not block:
+        if retry == 0.5:
+            print("[FORK] steemd does not have block {} yet; waiting".format(num))
+        time.sleep(retry)
+        retry = min(retry * 2, BLOCK_INTERVAL)
+        block = steemd.get_block(num)
+    return block['block_id']
+
+
+def pop_fork(steemd, defer_cache=False):
+    """ Pop our head blocks until the head is on steemd's chain.
+
+    Reversible blocks are undone from their undo log; posts they had
+    cached are re-fetched, or with `defer_cache` queued for the cache
+    worker. Everything steemd is asked for is fetched first, so the pops
+    and cache writes are one transaction. Returns (num, hash) of the new
+    head. """
+    head, head_hash = query_row("SELECT num, hash FROM hive_blocks ORDER BY num DESC LIMIT 1")
+    num, block_hash = head, head_hash
+    while num and steemd_block_id(steemd, num) != block_hash:
+        num -= 1
+        block_hash = query_one("SELECT hash FROM hive_blocks WHERE num = :num", num=num)
+    if num == head:
+        return num, block_hash
+
+    dirty = set()
+    for popped in range(num + 1, head + 1):
+        dirty |= undo.recached(popped)
+    # posts deleted in popped blocks will be reinstated, so fetch them too
+    sql = "SELECT id, author, permlink FROM hive_posts WHERE id IN :ids"
+    contents = fetch_posts([a + '/' + p for _, a, p in query_all(sql, ids=tuple(dirty))]
+                           if dirty and not defer_cache else [], steemd)
+    date = steemd.head_time()
+
+    # buffers and registries may hold state from popped blocks
+    posts.reset()
+    follow.reset()
+    undo.reset()
+
+    query("START TRANSACTION")
+    for popped in range(head, num, -1):
+        print("[FORK] Popping block {}".format(popped))
+        undo.pop_block(popped)
+    accounts.load_ids()
+
+    # posts created in popped blocks are gone
+    if dirty:
+        sql += " AND is_deleted = 0"
+        ids = {a + '/' + p: pid for pid, a, p in query_all(sql, ids=tuple(dirty))}
+        if defer_cache:
+            queue_posts(ids.values(), date)
+        else:
+            write_queries(cached_posts_sql(ids, [contents[url] for url in ids], date))
+    query("COMMIT")
+
+    # popped posts' ids are handed out again, so drop their payouts
+    load_payouts()
+    print("[FORK] Resuming from block {}".format(num))
+    return num, block_hash
+
+
+def defer_posts(ids, date):
+    """ Queue posts for the cache worker, in a live block's transaction. """
+    ids = list(ids)
+    if ids:
+        # popping the block restores the queue; pop_fork re-queues survivors
+        undo.snapshot('hive_dirty_posts', 'post_id IN :ids', ids=tuple(ids))
+        # the worker may cache them before the block is irreversible
+        undo.recache(ids)
+    queue_posts(ids, date)
+
+
+def db_block_time(num):
+    return query_one("SELECT created_at FROM hive_blocks WHERE num = :num", num=num)
+
+
+def wait_for_block(steemd, num, prev_time, trail_blocks=0):
+    """ Fetch block `num`, whose predecessor was produced at `prev_time`.
+
+    Blocks come every BLOCK_INTERVAL seconds, so rather than polling we
+    sleep until it (or the block `trail_blocks` after it) is due, then
+    retry briefly in case it is late or its slot was missed. """
+    due = prev_time + timedelta(seconds=BLOCK_INTERVAL * (1 + trail_blocks)
+                                + BLOCK_PROPAGATION)
+    delay = (due - datetime.utcnow()).total_seconds()
+    if delay > 0:
+        time.sleep(delay)
+
+    retry = 0.1
+    block = steemd.get_block(num)
+    while not block:
+        time.sleep(retry)
+        retry = min(retry * 2, 0.5)
+        block = steemd.get_block(num)
+    return block
+
+
+def listen_steemd(trail_blocks=0, catchup_blocks=CATCHUP_BLOCKS,
+                  vote_blocks=VOTE_WINDOW_BLOCKS, vote_secs=VOTE_WINDOW_SECS,
+                  defer_cache=False):
+    """ Follow the chain head, `trail_blocks` behind it.
+
+    Blocks above the last irreversible block are recorded in an undo log.
+    If a new block does not link to our head, the forked-out blocks are
+    popped and the new chain is processed in their place.
+
+    When more than `catchup_blocks` behind, irreversible blocks are synced
+    in batches (as on startup) before live processing resumes.
+
+    Posts only voted on are refreshed every `vote_blocks` blocks or
+    `vote_secs` seconds, whichever comes first (0 for every block).
+
+    With `defer_cache`, modified posts are only queued for the cache
+    worker, which also handles payouts. """
     steemd = get_adapter()
-    curr_block = db_last_block()
-    last_hash = False
+    curr_block, last_hash = pop_fork(steemd, defer_cache)
+    last_time = db_block_time(curr_block)
+    no_catchup_until = 0
+    voted = set()  # vote-only posts awaiting refresh
+    voted_since = (curr_block, time.time())
 
     while True:
+        behind = (datetime.utcnow() - last_time).total_seconds() / BLOCK_INTERVAL
+        if behind - trail_blocks > catchup_blocks and curr_block >= no_catchup_until:
+            print("[LIVE] {} blocks behind head at block {}; switching to batch sync".format(
+                int(behind), curr_block))
+            sync_from_steemd(is_initial_sync=False, defer_cache=defer_cache)
+            curr_block, last_hash = query_row(
+                "SELECT num, hash FROM hive_blocks ORDER BY num DESC LIMIT 1")
+            last_time = db_block_time(curr_block)
+            print("[LIVE] Caught up to block {} ({}s behind); resuming live mode".format(
+                curr_block, int((datetime.utcnow() - last_time).total_seconds())))
+            # if irreversibility itself is lagging, batch sync gets no
+            # further; stay live for a while before trying again
+            no_catchup_until = curr_block + catchup_blocks
+
         curr_block = curr_block + 1
 
-        # if trailing too close, take a pause
-        while trail_blocks > 0:
-            if curr_block <= steemd.head_block() - trail_blocks:
-                break
-            time.sleep(0.5)
+        # sleep until the block (or the one `trail_blocks` past it) is due
+        requests = steemd.request_count()
+        block = wait_for_block(steemd, curr_block, last_time, trail_blocks)
 
-        # get the target block; if DNE, pause and retry
-        block = steemd.get_block(curr_block)
-        while not block:
-            time.sleep(0.5)
-            block = steemd.get_block(curr_block)
+        # ensure the block we received links to our last
+        if last_hash and last_hash != block['previous']:
+            print("[FORK] Block {} does not link to our head {}".format(
+                block['block_id'], last_hash))
+            curr_block, last_hash = pop_fork(steemd, defer_cache)
+            last_time = db_block_time(curr_block)
+            continue
+        last_hash = block['block_id']
+        last_time = parse_time(block['timestamp'])
 
         num = int(block['block_id'][:8], base=16)
         print("[LIVE] Got block {} at {} with {} txs -- ".format(num,
             block['timestamp'], len(block['transactions'])), end='')
 
-        # ensure the block we received links to our last
-        if last_hash and last_hash != block['previous']:
-            # this condition is very rare unless trail_blocks is 0 and fork is
-            # encountered; to handle gracefully, implement a pop_block method
-            raise Exception("Unlinkable block: have {}, got {} -> {})".format(
-                last_hash, block['previous'], block['block_id']))
-        last_hash = block['block_id']
-
         start_time = time.time()
+        # a stale LIB only delays pruning; it never skips undo recording
+        lib = steemd.last_irreversible_block_num(max_age=30)
+
+        # read and fetch everything the block needs before taking locks
+        prefetch_posts([block])
+        dirty, block_voted = block_dirty_posts(block)
+        vote_tuples, vote_sql = [], []
+        if defer_cache:
+            dirty |= block_voted
+            paidout = []
+        else:
+            paidout = select_paidout_posts(block['timestamp'])
+            voted |= block_voted
+            voted -= dirty | set(a + '/' + p for _, a, p in paidout)
+            if (num - voted_since[0] >= vote_blocks
+                    or time.time() - voted_since[1] >= vote_secs):
+                # posts created in popped blocks no longer exist, so pending
+                # votes survive forks and catch-ups; just skip those posts
+                vote_tuples = urls_to_tuples(voted, skip_missing=True)
+                voted = set()
+                voted_since = (num, time.time())
+            # vote-only posts just get their votes updated, where possible
+            vote_sql, stale = vote_updates_sql(vote_tuples, steemd, block['timestamp'])
+            dirty |= set(a + '/' + p for _, a, p in stale)
+            contents = fetch_posts(dirty | set(a + '/' + p for _, a, p in paidout), steemd)
+
+        # then apply all of its writes in one short transaction
+        lock_time = time.time()
         query("START TRANSACTION")
-
-        dirty = process_block(block)
-        update_posts_batch(urls_to_tuples(dirty), steemd, block['timestamp'])
-
-        paidout = select_paidout_posts(block['timestamp'])
-        update_posts_batch(paidout, steemd, block['timestamp'])
-
-        print("{} edits, {} payouts".format(len(dirty), len(paidout)))
+        if num > lib:
+            undo.begin(num)
+
+        process_block(block)
+        flush_blocks()
+        ids = {a + '/' + p: pid for pid, a, p in urls_to_tuples(dirty) + list(paidout)}
+        cache_sql = []
+        if defer_cache:
+            defer_posts(ids.values(), block['timestamp'])
+        else:
+            undo.recache(list(ids.values()) + [pid for pid, _, _ in vote_tuples])
+            cache_sql = cached_posts_sql(ids, [contents[url] for url in ids],
+                                         block['timestamp'])
+            write_queries(cache_sql)
+            write_queries(vote_sql)
+
+        undo.end()
+        undo.prune(lib)
         query("COMMIT")
+        schedule_payouts(cache_sql)
+        locked = time.time() - lock_time
+
+        print("{} refreshed, {} vote updates, {} votes pending, {} payouts, {} rpcs, "
+              "{}ms locked, {}s behind".format(
+            len(dirty), len(vote_sql), len(voted), len(paidout), steemd.request_count() - requests,
+            int(locked * 1000), round((datetime.utcnow() - last_time).total_seconds(), 1)))
         secs = time.time() - start_time
 
         if secs > 1:
-            print("WARNING: block {} process took {}s".format(num, secs))
+            print("WARNING: block {} process took {}s ({})".format(
+                num, secs, steemd.rpc_stats()))
 
 
-def cache_missing_posts():
+def cache_missing_posts(defer_cache=False):
     # cached posts inserted sequentially, so just compare MAX(id)'s
     sql = ("SELECT (SELECT IFNULL(MAX(id), 0) FROM hive_posts) - "
            "(SELECT IFNULL(MAX(post_id), 0) FROM hive_posts_cache)")
@@ -431,6 +682,10 @@ def cache_missing_posts():
     if not missing_count:
         return
 
+    if defer_cache:
+        queue_missing_posts()
+        return
+
     # process in batches of 1m posts
     missing = select_missing_posts(1e6)
     while missing:
@@ -438,11 +693,17 @@ def cache_missing_posts():
         missing = select_missing_posts(1e6)
 
 
-def run():
+def run(trail_blocks=0, vote_blocks=VOTE_WINDOW_BLOCKS, vote_secs=VOTE_WINDOW_SECS,
+        defer_cache=False):
     # if tables not created, do so now
     if not query_row('SHOW TABLES'):
         print("[INIT] No tables found. Initializing db...")
         setup()
+    else:
+        upgrade()
+
+    # warm the account registry before any blocks are processed
+    accounts.load_ids()
 
     #TODO: if initial sync is interrupted, cache never rebuilt
     #TODO: do not build partial feed_cache during init_sync
@@ -453,11 +714,11 @@ def run():
         print("[INIT] *** Initial sync ***")
     else:
         # perform cleanup in case process did not exit cleanly
-        cache_missing_posts()
+        cache_missing_posts(defer_cache)
 
     # fast block sync strategies
     sync_from_checkpoints(is_initial_sync)
-    sync_from_steemd(is_initial_sync)
+    sync_from_steemd(is_initial_sync, defer_cache=defer_cache)
 
     if is_initial_sync:
         print("[INIT] *** Initial sync complete. Rebuilding cache. ***")
@@ -465,7 +726,8 @@ def run():
         rebuild_feed_cache()
 
     # initialization complete. follow head blocks
-    listen_steemd()
+    listen_steemd(trail_blocks, vote_blocks=vote_blocks, vote_secs=vote_secs,
+                  defer_cache=defer_cache)
 
 
 def head_state(*args):
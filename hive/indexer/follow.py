@@ -0,0 +1,102 @@
+import collections
+
+from hive.db.methods import query
+from hive.indexer import undo
+
+# follow and reblog state is collected per block batch, last write wins,
+# and written with bulk statements when the batch is flushed. a bot
+# toggling the same follow N times costs a single row write.
+_follows = collections.OrderedDict()  # (follower, following) -> [state, created_at]
+_reblogs = collections.OrderedDict()  # (account, post_id) -> [is_reblog, created_at, purge]
+
+
+def follow(follower, following, state, date):
+    key = (follower, following)
+    if key in _follows:
+        _follows[key][0] = state
+    else:
+        _follows[key] = [state, date]
+
+
+def reblog(account, post_id, date):
+    key = (account, post_id)
+    entry = _reblogs.get(key)
+    if not entry:
+        _reblogs[key] = [True, date, False]
+    elif not entry[0]:
+        # deleted earlier in this batch: drop the old row, then re-insert
+        _reblogs[key] = [True, date, True]
+
+
+def unreblog(account, post_id):
+    _reblogs[(account, post_id)] = [False, None, False]
+
+
+def has_reblogs(post_id):
+    return any(pid == post_id for (_, pid) in _reblogs)
+
+
+def reset():
+    """ Drop buffered state, e.g. after popping blocks. """
+    _follows.clear()
+    _reblogs.clear()
+
+
+def _keys_sql(keys, col1, col2):
+    params = {}
+    vals = []
+    for i, (val1, val2) in enumerate(keys):
+        vals.append("(:k%d_1, :k%d_2)" % (i, i))
+        params['k%d_1' % i] = val1
+        params['k%d_2' % i] = val2
+    return "(%s, %s) IN (%s)" % (col1, col2, ','.join(vals)), params
+
+
+def flush():
+    """ Write buffered follow and reblog state, 1000 keys per statement. """
+    follows = list(_follows.items())
+    for i in range(0, len(follows), 1000):
+        if undo.is_recording():
+            where, params = _keys_sql([key for key, _ in follows[i:i+1000]],
+                                      'follower', 'following')
+            undo.snapshot('hive_follows', where, **params)
+        params = {}
+        vals = []
+        for j, ((follower, following), (state, date)) in enumerate(follows[i:i+1000]):
+            vals.append("(:fr%d, :fg%d, :at%d, :st%d)" % (j, j, j, j))
+            params.update({'fr%d' % j: follower, 'fg%d' % j: following,
+                           'at%d' % j: date, 'st%d' % j: state})
+        sql = ("INSERT IGNORE INTO hive_follows (follower, following, created_at, state) "
+               "VALUES %s ON DUPLICATE KEY UPDATE state = VALUES(state)")
+        query(sql % ','.join(vals), **params)
+
+    if undo.is_recording():
+        keys = list(_reblogs.keys())
+        for i in range(0, len(keys), 1000):
+            where, params = _keys_sql(keys[i:i+1000], 'account', 'post_id')
+            undo.snapshot('hive_reblogs', where, **params)
+            undo.snapshot('hive_feed_cache', where, **params)
+
+    purge = [key for key, (is_reblog, _, purge) in _reblogs.items()
+             if purge or not is_reblog]
+    for i in range(0, len(purge), 1000):
+        where, params = _keys_sql(purge[i:i+1000], 'account', 'post_id')
+        query("DELETE FROM hive_reblogs WHERE %s" % where, **params)
+        query("DELETE FROM hive_feed_cache WHERE %s" % where, **params)
+
+    inserts = [(key, date) for key, (is_reblog, date, _) in _reblogs.items()
+               if is_reblog]
+    for i in range(0, len(inserts), 1000):
+        params = {}
+        vals = []
+        for j, ((account, post_id), date) in enumerate(inserts[i:i+1000]):
+            vals.append("(:a%d, :id%d, :at%d)" % (j, j, j))
+            params.update({'a%d' % j: account, 'id%d' % j: post_id, 'at%d' % j: date})
+        vals = ','.join(vals)
+        query("INSERT IGNORE INTO hive_reblogs (account, post_id, created_at) "
+              "VALUES %s" % vals, **params)
+        query("INSERT IGNORE INTO hive_feed_cache (account, post_id, created_at) "
+              "VALUES %s" % vals, **params)
+
+    _follows.clear()
+    _reblogs.clear()
@@ -2,11 +2,14 @@
 import concurrent.futures
 import json
 import logging
+import random
 import socket
+import threading
 import time
+from collections import deque
 from functools import partial
 from http.client import RemoteDisconnected
-from itertools import cycle
+from itertools import cycle, islice
 from urllib.parse import urlparse
 import gzip
 
@@ -16,12 +19,27 @@ import urllib3
 from urllib3.connection import HTTPConnection
 from urllib3.exceptions import MaxRetryError, ReadTimeoutError, ProtocolError
 
+from .json_stream import iter_array, loads
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.WARNING)
 
 class RPCError(Exception):
     pass
 
+_DONE = object()
+
+RETRY_ERRORS = (MaxRetryError,
+                ConnectionResetError,
+                ReadTimeoutError,
+                RemoteDisconnected,
+                ProtocolError)
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
 def chunkify(iterable, chunksize=3000):
     i = 0
     chunk = []
@@ -35,6 +53,130 @@ def chunkify(iterable, chunksize=3000):
     if chunk:
         yield chunk
 
+class AdaptiveLimit(object):
+    """ AIMD controller for batch size and number of requests in flight.
+
+    Every completed request reports its item count, latency, response size
+    and whether it failed or needed retries. Fast, clean requests grow the
+    batch size additively (and concurrency by one per window of successes);
+    errors or latency over `target_latency` halve both, at most once per
+    round trip: requests sent before the last cut were sent at the old
+    limit, so their signals don't cut again. Batch size is also capped so
+    a single response stays under `max_payload` bytes.
+    """
+
+    def __init__(self, batch_size=100, min_batch=10, max_batch=1000,
+                 inflight=2, max_inflight=16, target_latency=5.0,
+                 max_payload=32 * 1024 * 1024):
+        self.batch_size = batch_size
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.inflight = inflight
+        self.max_inflight = max_inflight
+        self.target_latency = target_latency
+        self.max_payload = max_payload
+        self.bytes_per_item = None
+        self.latency = None
+        self.errors = 0
+        self._successes = 0
+        self._decreased_at = 0
+        self._lock = threading.Lock()
+
+    def record(self, items, secs, nbytes=None, error=False):
+        with self._lock:
+            if nbytes and items:
+                per_item = nbytes / items
+                self.bytes_per_item = per_item if self.bytes_per_item is None \
+                    else 0.8 * self.bytes_per_item + 0.2 * per_item
+            self.latency = secs if self.latency is None \
+                else 0.8 * self.latency + 0.2 * secs
+
+            if error or secs > self.target_latency:
+                self.errors += int(error)
+                self._successes = 0
+                now = time.time()
+                if now - secs >= self._decreased_at:
+                    self._decreased_at = now
+                    self.batch_size = max(self.min_batch, self.batch_size // 2)
+                    self.inflight = max(1, self.inflight // 2)
+            else:
+                self._successes += 1
+                self.batch_size = min(self.max_batch,
+                                      self.batch_size + max(1, self.min_batch // 2))
+                if self._successes >= self.inflight:
+                    self._successes = 0
+                    self.inflight = min(self.max_inflight, self.inflight + 1)
+
+            if self.bytes_per_item:
+                cap = int(self.max_payload / self.bytes_per_item)
+                self.batch_size = max(self.min_batch, min(self.batch_size, cap))
+
+    def __str__(self):
+        return "batch {}x{}, {}s".format(self.batch_size, self.inflight,
+                                         round(self.latency or 0, 2))
+
+
+class Node(object):
+    """ A steemd endpoint, its measured latency and its circuit breaker.
+
+    After `threshold` consecutive failures the breaker opens and the node
+    gets no traffic for a cooldown which doubles on each trip (capped at a
+    minute). Once that passes a single probe request is let through
+    (half-open); success closes the breaker, failure re-opens it. """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, url, threshold=3):
+        self.url = url
+        self.threshold = threshold
+        self.latency = None  # ewma of seconds per request
+        self.requests = 0
+        self.failures = 0    # consecutive
+        self.state = Node.CLOSED
+        self.trips = 0
+        self.open_until = 0
+        self.probing = False
+
+    def available(self, now):
+        if self.state == Node.OPEN and now >= self.open_until:
+            self.state = Node.HALF_OPEN
+            self.probing = False
+        return self.state == Node.CLOSED or (
+            self.state == Node.HALF_OPEN and not self.probing)
+
+    def acquire(self):
+        if self.state == Node.HALF_OPEN:
+            self.probing = True
+
+    def release(self):
+        """ End a request; a failed probe has re-opened the breaker, and
+        any other outcome lets the next probe through. """
+        self.probing = False
+
+    def record(self, secs):
+        self.requests += 1
+        self.failures = 0
+        self.state = Node.CLOSED
+        self.trips = 0
+        self.latency = secs if self.latency is None \
+            else 0.9 * self.latency + 0.1 * secs
+
+    def fail(self, now):
+        """ Count a failure; returns True if this opened the breaker. """
+        self.failures += 1
+        if self.state == Node.HALF_OPEN or (
+                self.state == Node.CLOSED and self.failures >= self.threshold):
+            self.state = Node.OPEN
+            self.trips += 1
+            self.open_until = now + min(60, 2 ** self.trips)
+            return True
+        return False
+
+    def weight(self):
+        # unmeasured nodes get a fair share until they have a latency
+        return 1 / max(self.latency or 0.1, 0.001)
+
+
 class HttpClient(object):
     """ Simple Steem JSON-HTTP-RPC API
 
@@ -42,6 +184,9 @@ class HttpClient(object):
 
     Args:
       nodes (list): A list of Steem HTTP RPC nodes to connect to.
+      load_balance (bool): Spread requests across all healthy nodes,
+        weighted by measured latency, instead of using one node at a time
+        and only failing over.
 
     .. code-block:: python
 
@@ -66,9 +211,12 @@ class HttpClient(object):
     def __init__(self, nodes, **kwargs):
         self.return_with_args = kwargs.get('return_with_args', False)
         self.re_raise = kwargs.get('re_raise', True)
-        self.max_workers = kwargs.get('max_workers', None)
+        self.max_workers = kwargs.get('max_workers', 32)
+
+        self.load_balance = kwargs.get('load_balance', False)
 
-        num_pools = kwargs.get('num_pools', 10)
+        # one connection pool per node
+        num_pools = max(kwargs.get('num_pools', 10), len(nodes))
         maxsize = kwargs.get('maxsize', 10)
         timeout = kwargs.get('timeout', 60)
         retries = kwargs.get('retries', 20)
@@ -104,11 +252,40 @@ class HttpClient(object):
             **response_kw)
         '''
 
+        self.node_list = [Node(url) for url in nodes]
+        self._by_url = {node.url: node for node in self.node_list}
+        self._nodes_lock = threading.Lock()
+
+        # failures are retried here, across nodes, rather than by urllib3
+        # against the same node
+        self.node_retries = kwargs.get('node_retries', 1)
+        self.max_retries = kwargs.get('max_retries', 10)
+        self.backoff_base = kwargs.get('backoff_base', 0.1)
+        self.backoff_cap = kwargs.get('backoff_cap', 10)
+
+        # a request still outstanding at this percentile of recent latency
+        # for the same method is duplicated to a second node
+        self.hedge = kwargs.get('hedge', True)
+        self.hedge_percentile = kwargs.get('hedge_percentile', 95)
+        self.hedge_min = kwargs.get('hedge_min', 0.05)
+        self._hedge_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(32, 4 * maxsize * len(nodes)))
+        # long-lived worker threads for exec_multi_with_futures and
+        # exec_batch, shared by all callers
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers)
+        self._latencies = {}
+        self._all_latencies = deque(maxlen=1000)
+        self.stats = dict(requests=0, retries=0, hedged=0, hedge_wins=0,
+                          breaker_trips=0)
         self.nodes = cycle(nodes)
         self.url = ''
         self.request = None
         self.next_node()
 
+        # per-thread size and retry count of the last response, for metering
+        self._last = threading.local()
+
         log_level = kwargs.get('log_level', logging.WARNING)
         logger.setLevel(log_level)
 
@@ -128,6 +305,127 @@ class HttpClient(object):
     def hostname(self):
         return urlparse(self.url).hostname
 
+    def pick_node(self, exclude=None):
+        """ Choose a node whose circuit breaker lets traffic through.
+
+        With `load_balance` this is a weighted-random pick by inverse
+        latency; otherwise the current node, failing over in list order.
+        If every breaker is open, the node due to re-close first is used. """
+        with self._nodes_lock:
+            now = time.time()
+            nodes = [n for n in self.node_list if n is not exclude] or self.node_list
+            healthy = [n for n in nodes if n.available(now)]
+            if not healthy:
+                node = min(nodes, key=lambda n: n.open_until)
+            elif not self.load_balance:
+                node = self._by_url.get(self.url)
+                if node not in healthy:
+                    node = healthy[0]
+                    self.set_node(node.url)
+            else:
+                node = healthy[-1]
+                point = random.uniform(0, sum(n.weight() for n in healthy))
+                for candidate in healthy:
+                    point -= candidate.weight()
+                    if point <= 0:
+                        node = candidate
+                        break
+            node.acquire()
+            return node
+
+    def node_stats(self):
+        return ', '.join("{} {}ms/{}{}".format(
+            urlparse(n.url).netloc, int((n.latency or 0) * 1000), n.requests,
+            '' if n.state == Node.CLOSED else ' ' + n.state)
+                         for n in self.node_list)
+
+    def _observe(self, kind, secs):
+        with self._nodes_lock:
+            self._latencies.setdefault(kind, deque(maxlen=200)).append(secs)
+            self._all_latencies.append(secs)
+
+    def _hedge_delay(self, kind):
+        """ Seconds to wait on a request before hedging it, or None. """
+        if not self.hedge or len(self.node_list) < 2:
+            return None
+        with self._nodes_lock:
+            window = list(self._latencies.get(kind, ()))
+        if len(window) < 20:
+            return None
+        return max(self.hedge_min, _percentile(window, self.hedge_percentile))
+
+    def _post(self, node, kind, body, stream=False):
+        lap = time.time()
+        try:
+            response = self.http.urlopen('POST', node.url, body=body,
+                                         retries=self.node_retries,
+                                         preload_content=not stream)
+        except RETRY_ERRORS:
+            with self._nodes_lock:
+                if node.fail(time.time()):
+                    self.stats['breaker_trips'] += 1
+                    logger.warning('circuit open for %s', node.url)
+            raise
+        finally:
+            with self._nodes_lock:
+                node.release()
+        secs = time.time() - lap
+        with self._nodes_lock:
+            node.record(secs)
+        self._observe(kind, secs)
+        return response
+
+    def _send(self, kind, body, hedge=True, stream=False):
+        """ POST `body` to one node. If it is still outstanding after the
+        hedge delay, send a duplicate to another node and take whichever
+        succeeds first. Streamed responses are never hedged. """
+        node = self.pick_node()
+        delay = self._hedge_delay(kind) if hedge and not stream else None
+        if delay is None:
+            return self._post(node, kind, body, stream)
+
+        primary = self._hedge_pool.submit(self._post, node, kind, body)
+        done, _ = concurrent.futures.wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+        backup_node = self.pick_node(exclude=node)
+        if backup_node is node:
+            return primary.result()
+
+        with self._nodes_lock:
+            self.stats['hedged'] += 1
+        backup = self._hedge_pool.submit(self._post, backup_node, kind, body)
+        node_of = {primary: node, backup: backup_node}
+        pending = {primary, backup}
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is backup:
+                        with self._nodes_lock:
+                            self.stats['hedge_wins'] += 1
+                    # a loser still queued for a worker never starts, so
+                    # its node (maybe a half-open probe) is released here; a
+                    # running one can't be interrupted, but its response is
+                    # dropped and it still counts toward its node's latency
+                    for loser in pending:
+                        if loser.cancel():
+                            with self._nodes_lock:
+                                node_of[loser].release()
+                    return future.result()
+        return primary.result()
+
+    def metrics(self):
+        """ Request counters and latency percentiles (seconds) over the
+        last 1000 requests. """
+        with self._nodes_lock:
+            out = dict(self.stats)
+            window = list(self._all_latencies)
+        for pct in (50, 90, 99):
+            out['p%d' % pct] = round(_percentile(window, pct), 3) if window else None
+        return out
+
     @staticmethod
     def json_rpc_body(name, *args, api=None, as_json=True, _id=0):
         """ Build request body for steemd RPC requests.
@@ -155,58 +453,76 @@ class HttpClient(object):
         else:
             return body_dict
 
-    def exec(self, name, *args, api=None, return_with_args=None, _ret_cnt=0, body=None):
+    def exec(self, name, *args, api=None, return_with_args=None, body=None,
+             stream=False):
         """ Execute a method against steemd RPC.
 
+        With `stream`, the response is returned unread, for the caller to
+        decode as it arrives.
+
         Warnings:
             This command will auto-retry in case of node failure, as well as handle
             node fail-over, unless we are broadcasting a transaction.
             In latter case, the exception is **re-raised**.
         """
         body = body or HttpClient.json_rpc_body(name, *args, api=api)
+        # if we broadcast a transaction, never retry or hedge:
+        # this is to prevent potential for double spend scenario
+        broadcast = api == 'network_broadcast_api'
         response = None
-        try:
-            response = self.request(body=body)
-        except (MaxRetryError,
-                ConnectionResetError,
-                ReadTimeoutError,
-                RemoteDisconnected,
-                ProtocolError) as e:
-            # if we broadcasted a transaction, always raise
-            # this is to prevent potential for double spend scenario
-            if api == 'network_broadcast_api':
-                raise e
-
-            # try switching nodes before giving up
-            if _ret_cnt > 2:
-                time.sleep(_ret_cnt) # we should wait only a short period before trying the next node, but still slowly increase backoff
-            elif _ret_cnt > 10:
-                raise e
-            self.next_node()
-            logging.debug('Switched node to %s due to exception: %s' %
-                          (self.hostname, e.__class__.__name__))
-            return self.exec(name, *args,
-                             return_with_args=return_with_args,
-                             _ret_cnt=_ret_cnt + 1)
-        except Exception as e:
-            if self.re_raise:
-                raise e
-            else:
-                extra = dict(err=e, request=self.request)
-                logger.info('Request error', extra=extra)
-                return self._return(
-                    response=response,
-                    args=args,
-                    return_with_args=return_with_args)
-        else:
-            if response.status not in tuple(
-                    [*response.REDIRECT_STATUSES, 200]):
-                logger.info('non 200 response:%s', response.status)
-
-            return self._return(
-                response=response,
-                args=args,
-                return_with_args=return_with_args)
+        attempt = 0
+        while True:
+            try:
+                with self._nodes_lock:
+                    self.stats['requests'] += 1
+                response = self._send(name, body, hedge=not broadcast,
+                                      stream=stream)
+                break
+            except RETRY_ERRORS as e:
+                if broadcast or attempt >= self.max_retries:
+                    raise e
+                attempt += 1
+                self._backoff(name, attempt, e)
+            except Exception as e:
+                if self.re_raise:
+                    raise e
+                else:
+                    extra = dict(err=e, request=self.request)
+                    logger.info('Request error', extra=extra)
+                    return self._return(
+                        response=response,
+                        args=args,
+                        return_with_args=return_with_args)
+
+        if response.status not in tuple(
+                [*response.REDIRECT_STATUSES, 200]):
+            logger.info('non 200 response:%s', response.status)
+
+        self._last.retries = attempt
+        if stream:
+            return response
+
+        self._last.size = len(response.data)
+
+        return self._return(
+            response=response,
+            args=args,
+            return_with_args=return_with_args)
+
+    def _backoff(self, name, attempt, e):
+        """ Sleep before retry `attempt`: capped exponential, full jitter. """
+        with self._nodes_lock:
+            self.stats['retries'] += 1
+        delay = random.uniform(0, min(self.backoff_cap,
+                                      self.backoff_base * 2 ** attempt))
+        logging.debug('Retrying %s in %.2fs due to exception: %s' %
+                      (name, delay, e.__class__.__name__))
+        time.sleep(delay)
+
+    def _last_stats(self):
+        """ (bytes, had_retries) of this thread's last response """
+        return (getattr(self._last, 'size', None),
+                getattr(self._last, 'retries', 0) > 0)
 
     def _return(self, response=None, args=None, return_with_args=None):
         return_with_args = return_with_args or self.return_with_args
@@ -214,7 +530,7 @@ class HttpClient(object):
 
         if response:
             try:
-                response_json = json.loads(response.data.decode('utf-8'))
+                response_json = loads(response.data)
                 logger.debug(response_json)
             except Exception as e:
                 extra = dict(response=response, request_args=args, err=e)
@@ -239,19 +555,127 @@ class HttpClient(object):
         else:
             return result
 
-    def exec_multi_with_futures(self, name, params, api=None, max_workers=None):
-        with concurrent.futures.ThreadPoolExecutor(
-                max_workers=max_workers) as executor:
-            # Start the load operations and mark each future with its URL
-            def ensure_list(parameter):
-                return parameter if type(parameter) in (list, tuple, set) else [parameter]
+    def _stream(self, fn, items, window, ordered=True):
+        """ Run `fn` over `items` on the shared executor, with at most
+        `window()` calls in flight, yielding results as they complete or,
+        if `ordered`, in input order. Items are consumed lazily, so any
+        number of them streams through in constant memory. """
+        items = iter(items)
+        pending = deque()
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) < window():
+                    item = next(items, _DONE)
+                    if item is _DONE:
+                        exhausted = True
+                        break
+                    pending.append(self._executor.submit(fn, item))
+                if not pending:
+                    break
+                if ordered:
+                    yield pending.popleft().result()
+                else:
+                    done, _ = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        pending.remove(future)
+                        yield future.result()
+        finally:
+            # consumer stopped early or a call failed: drop queued work
+            for future in pending:
+                future.cancel()
+
+    def exec_multi_with_futures(self, name, params, api=None, max_workers=None,
+                                controller=None, ordered=False):
+        """ Yield results of single requests for each of `params`, as they
+        complete or, if `ordered`, in order of `params`.
+
+        Requests run on the client's shared executor; the number in flight
+        is `max_workers`, or taken from `controller` (AdaptiveLimit) before
+        each submit. """
+        def ensure_list(parameter):
+            return parameter if type(parameter) in (list, tuple, set) else [parameter]
+
+        def call(param):
+            lap = time.time()
+            try:
+                result = self.exec(name, *ensure_list(param), api=api)
+            except Exception:
+                if controller:
+                    controller.record(1, time.time() - lap, error=True)
+                raise
+            if controller:
+                controller.record(1, time.time() - lap, *self._last_stats())
+            return result
+
+        if controller:
+            window = lambda: controller.inflight
+        else:
+            limit = max_workers or self.max_workers
+            window = lambda: limit
+        return self._stream(call, params, window, ordered)
+
+    def _iter_batch(self, name, batch, controller=None):
+        """ Yield the result of each request in `batch`, decoding the
+        response element by element as it arrives (gunzipping on the fly),
+        so neither the raw body nor the whole parsed batch is held.
+
+        If the response breaks off, the requests not yet answered are sent
+        again. """
+        lap = time.time()
+        done = nbytes = attempt = 0
+        while done < len(batch):
+            response = self.exec('batch:' + name, body=json.dumps(batch[done:]).encode(),
+                                 stream=True)
+            attempt += self._last.retries
+
+            def chunks():
+                nonlocal nbytes
+                for chunk in response.stream(2 ** 16, decode_content=True):
+                    nbytes += len(chunk)
+                    yield chunk
 
-            futures = (executor.submit(self.exec, name, *ensure_list(param), api=api)
-                       for param in params)
-            for future in concurrent.futures.as_completed(futures):
-                yield future.result()
+            try:
+                for item in iter_array(chunks()):
+                    if not isinstance(item, dict) or 'result' not in item:
+                        raise RPCError("batch error: {}".format(item))
+                    done += 1
+                    yield item['result']
+                # drain trailing whitespace so the connection can be reused
+                response.read()
+                response.release_conn()
+            except RETRY_ERRORS + (ValueError,) as e:
+                response.close()
+                if attempt >= self.max_retries:
+                    raise e
+                attempt += 1
+                self._backoff(name, attempt, e)
+                continue
+            except BaseException:
+                response.close()
+                raise
+            assert done == len(batch), "batch_response len did not match params ({} vs {})".format(done, len(batch))
+
+        self._last.size = nbytes
+        self._last.retries = attempt
+        if controller:
+            controller.record(len(batch), time.time() - lap, *self._last_stats())
+
+    def _exec_batch(self, name, batch, controller=None):
+        lap = time.time()
+        try:
+            return list(self._iter_batch(name, batch, controller))
+        except Exception:
+            if controller:
+                controller.record(len(batch), time.time() - lap, error=True)
+            raise
 
-    def exec_batch(self, name, params, batch_size=None):
+    def exec_batch(self, name, params, batch_size=None, controller=None):
+        """ Yield results of `name` for each of `params`, in order.
+
+        With a `controller` (AdaptiveLimit), batch size and the number of
+        batches in flight are taken from it before each request. """
         batch_size = batch_size or self.batch_size
 
         batch_requests = ({
@@ -261,14 +685,22 @@ class HttpClient(object):
                 "id": 0
             } for i in params)
 
-
-        for batch in chunkify(batch_requests, batch_size):
-            body = json.dumps(batch).encode()
-            batch_response = self.exec('ignore',[], body=body)
-            assert batch_response, "batch_response was empty"
-            assert len(batch_response) == len(batch), "batch_response len did not match params ({} vs {})".format(len(batch_response), len(batch))
-            for response in batch_response:
-                yield response['result']
+        if not controller:
+            for batch in chunkify(batch_requests, batch_size):
+                yield from self._iter_batch(name, batch)
+            return
+
+        def batches():
+            while True:
+                batch = list(islice(batch_requests, controller.batch_size))
+                if not batch:
+                    return
+                yield batch
+
+        for results in self._stream(
+                lambda batch: self._exec_batch(name, batch, controller),
+                batches(), lambda: controller.inflight):
+            yield from results
 
 
 if __name__ == '__main__':
@@ -0,0 +1,90 @@
+# coding=utf-8
+""" JSON decoding for RPC responses: ujson where available, and an
+incremental splitter for top-level arrays (JSON-RPC batch responses). """
+import re
+
+try:
+    import ujson as _json
+except ImportError:
+    import json as _json
+
+# structural bytes outside of strings, and the bytes ending a string run
+_TOKENS = re.compile(rb'[\[\]{},"]')
+_STRING = re.compile(rb'["\\]')
+_SPACE = b' \t\r\n'
+
+
+def loads(data):
+    """ Parse a JSON document from bytes or str. """
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode('utf-8')
+    return _json.loads(data)
+
+
+def iter_array(chunks):
+    """ Parse a top-level JSON array from an iterable of byte chunks,
+    yielding each element as soon as it is complete.
+
+    Only the current, unfinished element is buffered. A document which is
+    not an array (e.g. a JSON-RPC error object) is yielded whole. """
+    buf = bytearray()
+    pos = 0          # scan position in buf
+    start = None     # start of the current element
+    depth = 0
+    in_string = False
+    is_array = None
+
+    for chunk in chunks:
+        buf += chunk
+        if is_array is None:
+            stripped = buf.lstrip(_SPACE)
+            if not stripped:
+                continue
+            is_array = stripped[:1] == b'['
+        if not is_array:
+            continue
+
+        while True:
+            if in_string:
+                match = _STRING.search(buf, pos)
+                if not match:
+                    pos = len(buf)
+                    break
+                if match.group() == b'\\':
+                    if match.end() >= len(buf):
+                        pos = match.start()  # escape split across chunks
+                        break
+                    pos = match.end() + 1
+                    continue
+                in_string = False
+                pos = match.end()
+                continue
+
+            match = _TOKENS.search(buf, pos)
+            if not match:
+                pos = len(buf)
+                break
+            token = match.group()
+            pos = match.end()
+            if token == b'"':
+                in_string = True
+            elif token in b'[{':
+                depth += 1
+                if depth == 1:
+                    start = pos
+            elif depth == 1 and token in b',]':
+                element = buf[start:match.start()].strip(_SPACE)
+                if element:
+                    yield loads(bytes(element))
+                if token == b']':
+                    return
+                # drop what has been parsed, keeping buf small
+                del buf[:pos]
+                pos = start = 0
+            elif token in b']}':
+                depth -= 1
+
+    if is_array is False:
+        yield loads(bytes(buf))
+    elif is_array:
+        raise ValueError('truncated JSON array')
@@ -0,0 +1,148 @@
+import collections
+
+from hive.db.methods import query, query_all, query_one
+from hive.indexer import undo
+
+# bounded LRU of (author, permlink) -> (id, depth, category, community,
+# is_deleted). a None value records a post known not to exist. entries are
+# written on insert, so replies and votes on recent posts never query.
+CACHE_SIZE = 500000
+
+_cache = collections.OrderedDict()
+
+# new hive_posts and hive_feed_cache rows are buffered for the length of a
+# block batch and written with multi-row INSERTs. ids are allocated here,
+# so children can reference parents which have not been written yet.
+_last_id = None
+_pending = collections.OrderedDict()
+_pending_feed = collections.OrderedDict()
+
+
+def _remember(key, row):
+    _cache[key] = row
+    _cache.move_to_end(key)
+    if len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+def get(author, permlink):
+    key = (author, permlink)
+    if key not in _cache:
+        return get_many([key]).get(key)
+    _cache.move_to_end(key)
+    return _cache[key]
+
+
+def get_many(keys):
+    """ Resolve a set of (author, permlink) keys, hitting the db once per
+    1000 cache misses. Returns a dict of key -> row for existing posts. """
+    keys = set(keys)
+    missing = [key for key in keys if key not in _cache]
+    for i in range(0, len(missing), 1000):
+        batch = missing[i:i+1000]
+        found = _select_rows(batch)
+        for key in batch:
+            _remember(key, found.get(key))
+
+    out = {}
+    for key in keys:
+        row = _cache.get(key)
+        if row:
+            _cache.move_to_end(key)
+            out[key] = row
+    return out
+
+
+def _select_rows(keys):
+    params = {}
+    vals = []
+    for i, (author, permlink) in enumerate(keys):
+        vals.append("(:a%d, :p%d)" % (i, i))
+        params['a%d' % i] = author
+        params['p%d' % i] = permlink
+    sql = ("SELECT author, permlink, id, depth, category, community, is_deleted "
+           "FROM hive_posts WHERE (author, permlink) IN (%s)" % ','.join(vals))
+    return {(r[0], r[1]): tuple(r[2:]) for r in query_all(sql, **params)}
+
+
+def put(author, permlink, pid, depth, category, community, is_deleted=0):
+    _remember((author, permlink), (pid, depth, category, community, is_deleted))
+
+
+def set_deleted(author, permlink, is_deleted=1):
+    key = (author, permlink)
+    row = _cache.get(key)
+    if row:
+        _cache[key] = row[:4] + (is_deleted,)
+
+
+def reset():
+    """ Forget cached and buffered posts and the id counter, e.g. after
+    popping blocks. """
+    global _last_id
+    _cache.clear()
+    _pending.clear()
+    _pending_feed.clear()
+    _last_id = None
+
+
+def next_id():
+    global _last_id
+    if _last_id is None:
+        _last_id = query_one("SELECT IFNULL(MAX(id), 0) FROM hive_posts")
+    _last_id += 1
+    return _last_id
+
+
+def insert(pid, op, parent_id, category, community, depth, is_valid, date):
+    _pending[pid] = {
+        'id': pid,
+        'is_valid': is_valid,
+        'parent_id': parent_id,
+        'author': op['author'],
+        'permlink': op['permlink'],
+        'category': category,
+        'community': community,
+        'depth': depth,
+        'created_at': date}
+    put(op['author'], op['permlink'], pid, depth, category, community)
+
+
+def insert_feed(account, pid, date):
+    _pending_feed[pid] = (account, date)
+
+
+def is_pending(pid):
+    return pid in _pending or pid in _pending_feed
+
+
+def flush():
+    """ Write buffered hive_posts and hive_feed_cache rows, 1000 per INSERT. """
+    rows = list(_pending.values())
+    if rows:
+        undo.snapshot('hive_posts', 'id IN :ids', ids=tuple(_pending.keys()))
+    cols = ['id', 'is_valid', 'parent_id', 'author', 'permlink',
+            'category', 'community', 'depth', 'created_at']
+    for i in range(0, len(rows), 1000):
+        params = {}
+        vals = []
+        for j, row in enumerate(rows[i:i+1000]):
+            vals.append("(%s)" % ', '.join([':%s%d' % (col, j) for col in cols]))
+            params.update({'%s%d' % (col, j): row[col] for col in cols})
+        sql = "INSERT INTO hive_posts (%s) VALUES %s" % (', '.join(cols), ','.join(vals))
+        query(sql, **params)
+
+    feed = list(_pending_feed.items())
+    if feed:
+        undo.snapshot('hive_feed_cache', 'post_id IN :ids', ids=tuple(_pending_feed.keys()))
+    for i in range(0, len(feed), 1000):
+        params = {}
+        vals = []
+        for j, (pid, (account, date)) in enumerate(feed[i:i+1000]):
+            vals.append("(:a%d, :id%d, :at%d)" % (j, j, j))
+            params.update({'a%d' % j: account, 'id%d' % j: pid, 'at%d' % j: date})
+        sql = "INSERT INTO hive_feed_cache (account, post_id, created_at) VALUES "
+        query(sql + ','.join(vals), **params)
+
+    _pending.clear()
+    _pending_feed.clear()
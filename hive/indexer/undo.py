@@ -0,0 +1,119 @@
+import json
+
+from hive.db.methods import query, query_all, query_one
+
+# undo log for reversible blocks. before any write while a block is being
+# recorded, the rows it may touch are snapshotted; popping the block deletes
+# whatever matches each snapshot's WHERE and re-inserts the saved rows, in
+# reverse order. hive_posts_cache and hive_post_tags are derived from
+# steemd, so instead of snapshots they are re-fetched for the posts a
+# popped block cached.
+_block = None
+_entries = []
+
+
+def begin(num):
+    global _block, _entries
+    _block = num
+    _entries = []
+
+
+def reset():
+    """ Drop a block's unsaved log, e.g. after popping blocks. """
+    global _block, _entries
+    _block = None
+    _entries = []
+
+
+def is_recording():
+    return _block is not None
+
+
+def snapshot(table, where, **params):
+    """ Save rows of `table` matching `where`, before writing to them. """
+    if _block is None:
+        return
+    rows = [dict(row) for row in query_all(
+        "SELECT * FROM %s WHERE %s" % (table, where), **params)]
+    _entries.append({'table': table, 'where': where,
+                     'params': params, 'rows': rows})
+
+
+def recache(post_ids):
+    """ Note posts whose cache rows the block writes. """
+    if _block is None or not post_ids:
+        return
+    _entries.append({'recache': list(post_ids)})
+
+
+def end():
+    """ Save the block's undo log, in the block's transaction. """
+    global _block
+    if _block is None:
+        return
+    query("INSERT INTO hive_undo (num, entries) VALUES (:num, :entries)",
+          num=_block, entries=json.dumps(_entries, default=str))
+    _block = None
+
+
+def prune(last_irreversible):
+    query("DELETE FROM hive_undo WHERE num <= :num", num=last_irreversible)
+
+
+def _params(params):
+    # IN-clause tuples come back from json as lists
+    return {k: tuple(v) if isinstance(v, list) else v
+            for k, v in params.items()}
+
+
+def recached(num):
+    """ Ids of posts whose cache rows block `num` wrote. """
+    entries = query_one("SELECT entries FROM hive_undo WHERE num = :num", num=num)
+    post_ids = set()
+    for entry in json.loads(entries or '[]'):
+        post_ids |= set(entry.get('recache', []))
+    return post_ids
+
+
+def pop_block(num):
+    """ Revert everything block `num` wrote. Returns ids of posts whose
+    cache must be refreshed. """
+    entries = query_one("SELECT entries FROM hive_undo WHERE num = :num", num=num)
+    if entries is None:
+        raise Exception("Cannot pop block {}: no undo log".format(num))
+    entries = json.loads(entries)
+
+    post_ids = set()
+    for entry in entries:
+        post_ids |= set(entry.get('recache', []))
+    if post_ids:
+        query("DELETE FROM hive_posts_cache WHERE post_id IN :ids", ids=tuple(post_ids))
+        query("DELETE FROM hive_post_tags WHERE post_id IN :ids", ids=tuple(post_ids))
+
+    for entry in reversed(entries):
+        if 'table' not in entry:
+            continue
+        table, params = entry['table'], _params(entry['params'])
+        if table == 'hive_posts':
+            # replies reference their parents and innodb checks each row as
+            # it goes: keep saved posts, and delete new ones replies first
+            saved = tuple(row['id'] for row in entry['rows'])
+            sql = "DELETE FROM hive_posts WHERE (%s)" % entry['where']
+            if saved:
+                sql += " AND id NOT IN :undo_saved"
+                params['undo_saved'] = saved
+            query(sql + " ORDER BY id DESC", **params)
+        else:
+            query("DELETE FROM %s WHERE %s" % (table, entry['where']), **params)
+
+        for row in entry['rows']:
+            cols = list(row.keys())
+            sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+                table, ', '.join(cols), ', '.join(':' + c for c in cols))
+            if table == 'hive_posts':
+                sql += " ON DUPLICATE KEY UPDATE " + ', '.join(
+                    "%s = VALUES(%s)" % (c, c) for c in cols)
+            query(sql, **row)
+
+    query("DELETE FROM hive_undo WHERE num = :num", num=num)
+    return post_ids
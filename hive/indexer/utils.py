@@ -1,8 +1,13 @@
+import asyncio
 import os
+import threading
 import time
 
 from datetime import datetime
-from .http_client import HttpClient
+from itertools import islice
+from .http_client import HttpClient, AdaptiveLimit
+from .async_client import AsyncHttpClient
+from .block_store import BlockStore
 
 def amount(string):
     return float(string.split(' ')[0])
@@ -11,29 +16,83 @@ def parse_time(block_time):
     return datetime.strptime(block_time, '%Y-%m-%dT%H:%M:%S')
 
 
+def block_num(block):
+    return int(block['block_id'][:8], base=16)
+
+
 _shared_adapter = None
 def get_adapter():
     global _shared_adapter
     if not _shared_adapter:
         steem = os.environ.get('STEEMD_URL')
         jussi = os.environ.get('JUSSI_URL')
-        _shared_adapter = SteemAdapter(steem, jussi)
+        store = os.environ.get('BLOCK_STORE_DIR')
+        store = BlockStore(store) if store else None
+        if os.environ.get('STEEMD_CLIENT') == 'async':
+            _shared_adapter = AsyncSteemAdapter(steem, jussi, store)
+        else:
+            _shared_adapter = SteemAdapter(steem, jussi, store)
     return _shared_adapter
 
 
 class SteemAdapter:
+    _gdgp_cache = None  # (fetched_at, props)
+
+    def __init__(self, api_endpoint, jussi=None, block_store=None):
+        """ Either endpoint may be a comma-separated list of urls; with
+        several, requests are spread across all of them by latency.
 
-    def __init__(self, api_endpoint, jussi=None):
+        With a `block_store`, blocks it holds are served from disk and
+        irreversible blocks fetched from steemd are written through. """
+        self._store = block_store
+        self._lib = 0
         self._jussi = bool(jussi)
         url = jussi or api_endpoint
         assert url, 'steem-API endpoint undefined'
-        self._client = HttpClient(nodes=[url])
+        nodes = url.split(',')
+        self._limit = self._make_limit(nodes)
+        self._client = self._make_client(nodes)
+
+    def _make_limit(self, nodes):
+        # batch size and concurrency are tuned from observed latency, error
+        # rate and payload size. jussi takes large batches; steemd, one
+        # request per call with many in flight.
+        # the in-flight ceiling grows with the number of nodes we spread over
+        if self._jussi:
+            return AdaptiveLimit(batch_size=100, max_batch=1000,
+                                 inflight=2, max_inflight=8 * len(nodes))
+        return AdaptiveLimit(batch_size=1, min_batch=1, max_batch=1,
+                             inflight=10, max_inflight=50 * len(nodes))
+
+    def _make_client(self, nodes):
+        # the block prefetcher and the main thread may both be fetching
+        return HttpClient(nodes=nodes, load_balance=len(nodes) > 1,
+                          maxsize=50,
+                          max_workers=2 * self._limit.max_inflight)
+
+    def fetch_settings(self):
+        """ current batch/concurrency settings, for progress output """
+        if self._client.load_balance:
+            return "{}, {}; {}".format(self._limit, self.rpc_stats(),
+                                       self._client.node_stats())
+        return "{}, {}".format(self._limit, self.rpc_stats())
+
+    def rpc_stats(self):
+        """ request latency percentiles, hedging, retry and breaker counts """
+        stats = self._client.metrics()
+        return "p50 {}s p99 {}s, {} hedged ({} won), {} retries, {} trips".format(
+            stats['p50'], stats['p99'], stats['hedged'], stats['hedge_wins'],
+            stats['retries'], stats['breaker_trips'])
+
+    def sync_window(self):
+        """ blocks per sync range: enough to keep every request slot busy """
+        return min(max(self._limit.batch_size * self._limit.inflight * 2, 200), 5000)
 
     def get_accounts(self, accounts):
-        return self.__exec('get_accounts', accounts)
+        return self._exec('get_accounts', accounts)
 
     def get_content_batch(self, tuples):
-        posts = self.__exec_batch('get_content', tuples)
+        posts = self._exec_batch('get_content', tuples)
 
         # sanity-checking jussi responses
         for post in posts:
@@ -42,57 +101,155 @@ class SteemAdapter:
 
         return posts
 
-    def get_block(self, num):
-        return self.__exec('get_block', num)
+    def get_active_votes_batch(self, tuples):
+        return self._exec_batch('get_active_votes', tuples)
 
-    def _gdgp(self):
-        ret = self.__exec('get_dynamic_global_properties')
+    def get_block(self, num):
+        if self._store and self._store.has(num):
+            return self._store.get(num)
+        block = self._exec('get_block', num)
+        if block and self._store and num <= self._lib:
+            self._store.append(num, block)
+        return block
+
+    def request_count(self):
+        """ HTTP requests made so far, for per-block accounting """
+        return self._client.stats['requests']
+
+    def _gdgp(self, max_age=0):
+        """ Dynamic global properties; reused if fetched in the last
+        `max_age` seconds. """
+        if max_age and self._gdgp_cache and \
+                time.time() - self._gdgp_cache[0] < max_age:
+            return self._gdgp_cache[1]
+
+        ret = self._exec('get_dynamic_global_properties')
         tries = 0
         while not ret:
             tries += 1
             print("gdgp failure, retry in {}s".format(tries))
             time.sleep(tries)
-            ret = self.__exec('get_dynamic_global_properties')
+            ret = self._exec('get_dynamic_global_properties')
 
         assert ret, "empty response for gdgp: {}".format(ret)
         assert isinstance(ret, dict), "gdgp was not a dict"
         assert 'time' in ret, "gdgp invalid resp: {}".format(ret)
+        self._lib = ret['last_irreversible_block_num']
+        self._gdgp_cache = (time.time(), ret)
         return ret
 
-    def head_time(self):
-        return self._gdgp()['time']
+    def head_time(self, max_age=0):
+        return self._gdgp(max_age)['time']
 
-    def head_block(self):
-        return self._gdgp()['head_block_number']
+    def head_block(self, max_age=0):
+        return self._gdgp(max_age)['head_block_number']
 
-    def last_irreversible_block_num(self):
-        return self._gdgp()['last_irreversible_block_num']
+    def last_irreversible_block_num(self, max_age=0):
+        return self._gdgp(max_age)['last_irreversible_block_num']
 
     def get_blocks_range(self, lbound, ubound): # [lbound, ubound)
-        block_nums = range(lbound, ubound)
-        required = set(block_nums)
-        available = set()
-        missing = required - available
-        blocks = {}
-
-        while missing:
-            for block in self.__exec_batch('get_block', [[i] for i in missing]):
-                assert 'block_id' in block, "invalid block: {}".format(block)
-                blocks[int(block['block_id'][:8], base=16)] = block
-            available = set(blocks.keys())
-            missing = required - available
-            if missing:
-                print("WARNING: API missed blocks {}".format(missing))
+        return list(self.stream_blocks(lbound, ubound))
+
+    def stream_blocks(self, lbound, ubound):
+        """ Yield blocks [lbound, ubound) in order, with a bounded number of
+        requests in flight. A block the API fails to return is re-requested
+        on its own. """
+        if self._store and self._store.has(lbound):
+            stored = min(ubound, self._store.head + 1)
+            for start in range(lbound, stored, 1000):
+                yield from self._store.get_range(start, min(start + 1000, stored))
+            lbound = stored
+
+        results = self._exec_stream('get_block', ([i] for i in range(lbound, ubound)))
+        for num, block in zip(range(lbound, ubound), results):
+            while not (block and 'block_id' in block and block_num(block) == num):
+                print("WARNING: API missed block {}".format(num))
                 time.sleep(3)
+                block = self._exec('get_block', num)
+            if self._store and num <= self._lib:
+                self._store.append(num, block)
+            yield block
 
-        return [blocks[x] for x in block_nums]
-
-    def __exec(self, method, *params):
+    def _exec(self, method, *params):
         return self._client.exec(method, *params)
 
-    def __exec_batch(self, method, params):
+    def _exec_stream(self, method, params):
+        """Like _exec_batch, but lazy: results are yielded in order."""
+        if self._jussi:
+            return self._client.exec_batch(method, params,
+                                           controller=self._limit)
+        return self._client.exec_multi_with_futures(
+            method, params, controller=self._limit, ordered=True)
+
+    def _exec_batch(self, method, params):
         """If jussi is enabled, use batch requests; otherwise, multi"""
         if self._jussi:
-            return list(self._client.exec_batch(method, params, batch_size=500))
+            return list(self._client.exec_batch(method, params,
+                                                controller=self._limit))
         return list(self._client.exec_multi_with_futures(
-            method, params, max_workers=10))
+            method, params, controller=self._limit, ordered=True))
+
+
+def _run_loop(loop):
+    asyncio.set_event_loop(loop)
+    loop.run_forever()
+
+
+class AsyncSteemAdapter(SteemAdapter):
+    """ SteemAdapter over AsyncHttpClient.
+
+    Requests run on an event loop in a background thread, so hundreds can
+    be in flight on keep-alive connections without a thread each. The
+    public methods block, like SteemAdapter's. """
+
+    def __init__(self, api_endpoint, jussi=None, block_store=None):
+        super().__init__(api_endpoint, jussi, block_store)
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=_run_loop, args=(self._loop,),
+                         daemon=True).start()
+
+    def _make_limit(self, nodes):
+        # in-flight calls are cheap here, so start and cap much higher
+        if self._jussi:
+            return AdaptiveLimit(batch_size=100, max_batch=1000,
+                                 inflight=4, max_inflight=64)
+        return AdaptiveLimit(batch_size=1, min_batch=1, max_batch=1,
+                             inflight=100, max_inflight=500)
+
+    def _make_client(self, nodes):
+        # the block prefetcher and the main thread may both be fetching
+        return AsyncHttpClient(
+            nodes, max_connections=2 * self._limit.max_inflight)
+
+    def _submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def _map(self, method, params):
+        if self._jussi:
+            return self._client.exec_batch(method, params, controller=self._limit)
+        return self._client.exec_multi(method, params, controller=self._limit)
+
+    def _exec(self, method, *params):
+        return self._submit(self._client.exec(method, *params)).result()
+
+    def _exec_batch(self, method, params):
+        return self._submit(self._map(method, list(params))).result()
+
+    def _exec_stream(self, method, params):
+        """ Results in order, one sync window at a time; the next window is
+        in flight while the current one is consumed. """
+        params = iter(params)
+
+        def submit():
+            chunk = list(islice(params, self.sync_window()))
+            return self._submit(self._map(method, chunk)) if chunk else None
+
+        future = submit()
+        try:
+            while future:
+                results = future.result()
+                future = submit()
+                yield from results
+        finally:
+            if future:
+                future.cancel()
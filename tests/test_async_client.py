@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+
+from hive.indexer.http_client import AdaptiveLimit, RPCError
+from hive.indexer.utils import AsyncSteemAdapter, SteemAdapter, block_num
+
+
+class StandInSteemd(BaseHTTPRequestHandler):
+    """ Answers get_block and get_accounts after a fixed delay. """
+    protocol_version = 'HTTP/1.1'
+    delay = 0.02
+    connections = 0
+    inflight = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        StandInSteemd.connections += 1
+        super().setup()
+
+    def log_message(self, *args):
+        pass
+
+    @staticmethod
+    def result(req):
+        if req['method'] == 'get_block':
+            num = req['params'][0]
+            return {'id': req['id'], 'jsonrpc': '2.0', 'result': {
+                'block_id': '%08x' % num + 'a' * 32,
+                'previous': '%08x' % (num - 1) + 'a' * 32,
+                'timestamp': '2017-01-01T00:00:00', 'transactions': []}}
+        if req['method'] == 'get_accounts':
+            return {'id': req['id'], 'jsonrpc': '2.0',
+                    'result': [{'name': name} for name in req['params'][0]]}
+        return {'id': req['id'], 'jsonrpc': '2.0',
+                'error': {'code': -32601, 'message': 'no such method'}}
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode())
+        cls = StandInSteemd
+        with cls.lock:
+            cls.inflight += 1
+            cls.peak = max(cls.peak, cls.inflight)
+        time.sleep(self.delay)
+        with cls.lock:
+            cls.inflight -= 1
+        out = [self.result(r) for r in body] if isinstance(body, list) \
+            else self.result(body)
+        data = json.dumps(out).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+@pytest.fixture(scope='module')
+def steemd():
+    server = Server(('127.0.0.1', 0), StandInSteemd)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield 'http://127.0.0.1:%d' % server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('jussi', [False, True])
+def test_blocks_range_in_order(steemd, jussi):
+    adapter = AsyncSteemAdapter(steemd, jussi=steemd if jussi else None)
+    blocks = adapter.get_blocks_range(10, 1510)
+    assert [block_num(block) for block in blocks] == list(range(10, 1510))
+    assert block_num(adapter.get_block(7)) == 7
+
+
+def test_keep_alive(steemd):
+    adapter = AsyncSteemAdapter(steemd)
+    # pinned, so AIMD can't move the number of requests in flight
+    adapter._limit = AdaptiveLimit(batch_size=1, min_batch=1, max_batch=1,
+                                   inflight=20, max_inflight=20,
+                                   target_latency=float('inf'))
+    before = StandInSteemd.connections
+    adapter.get_blocks_range(1, 1001)
+    adapter.get_blocks_range(1, 1001)
+    # one connection per request in flight, reused across both ranges
+    assert StandInSteemd.connections - before <= 20
+
+
+def test_calls_and_errors(steemd):
+    adapter = AsyncSteemAdapter(steemd)
+    assert adapter.get_accounts(['alice', 'bob']) == [{'name': 'alice'},
+                                                      {'name': 'bob'}]
+    with pytest.raises(RPCError):
+        adapter._exec('get_nothing')
+
+
+def test_more_in_flight_than_threaded_at_high_fan_out(steemd):
+    def peak(adapter):
+        StandInSteemd.peak = 0
+        assert len(adapter.get_blocks_range(1, 3001)) == 3000
+        return StandInSteemd.peak
+
+    threaded = SteemAdapter(steemd)
+    threaded_peak = peak(threaded)
+    asynced_peak = peak(AsyncSteemAdapter(steemd))
+    # more requests in flight than the threaded adapter's ceiling allows
+    assert asynced_peak > max(threaded_peak, threaded._limit.max_inflight)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+
+from hive.indexer import block_store
+from hive.indexer.block_store import BlockStore
+
+
+def block(num):
+    return {'block_id': '%08x' % num + 'a' * 32, 'previous': '%08x' % (num - 1),
+            'timestamp': '2017-01-01T00:00:00', 'transactions': []}
+
+
+@pytest.fixture
+def store(tmpdir, monkeypatch):
+    monkeypatch.setattr(block_store, 'SEGMENT_BLOCKS', 4)
+    store = BlockStore(str(tmpdir))
+    for num in range(10, 20):
+        assert store.append(num, block(num))
+    yield store
+    store.close()
+
+
+def reopen(store):
+    store.close()
+    return BlockStore(store.path)
+
+
+def segment_files(store):
+    base = store._segments[-1].base
+    return (os.path.join(store.path, '%09d.dat' % base),
+            os.path.join(store.path, '%09d.idx' % base))
+
+
+def test_append_and_read_across_segments(store):
+    assert (store.first, store.head) == (10, 19)
+    assert len(store._segments) == 3
+    assert store.get(13) == block(13)
+    assert store.get_range(11, 19) == [block(n) for n in range(11, 19)]
+    # only the next block extends the range
+    assert not store.append(21, block(21))
+    assert not store.append(15, block(15))
+    with pytest.raises(AssertionError):
+        store.get_range(18, 21)
+
+
+def test_reopen(store):
+    store = reopen(store)
+    assert (store.first, store.head) == (10, 19)
+    assert store.append(20, block(20))
+    assert store.get_range(17, 21) == [block(n) for n in range(17, 21)]
+    store.close()
+
+
+def test_unindexed_record_is_truncated(store):
+    # crash after writing a record but before its index entry
+    data_path, idx_path = segment_files(store)
+    size = os.path.getsize(data_path)
+    with open(data_path, 'ab') as f:
+        f.write(b'{"block_id":"torn')
+    store = reopen(store)
+    assert store.head == 19
+    assert os.path.getsize(data_path) == size
+    assert store.append(20, block(20))
+    assert store.get_range(18, 21) == [block(n) for n in range(18, 21)]
+    store.close()
+
+
+def test_partial_index_entry_is_dropped(store):
+    data_path, idx_path = segment_files(store)
+    with open(idx_path, 'ab') as f:
+        f.write(b'\x01\x02\x03')
+    store = reopen(store)
+    assert store.head == 19
+    assert os.path.getsize(idx_path) % 8 == 0
+    assert store.get(19) == block(19)
+    store.close()
+
+
+def test_index_past_end_of_data_is_dropped(store):
+    # index entry flushed, but the record it points at never hit the disk
+    data_path, idx_path = segment_files(store)
+    with open(data_path, 'rb+') as f:
+        f.truncate(os.path.getsize(data_path) - 5)
+    store = reopen(store)
+    assert store.head == 18
+    assert store.get_range(16, 19) == [block(n) for n in range(16, 19)]
+    assert store.append(19, block(19))
+    assert store.get(19) == block(19)
+    store.close()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+import pytest
+
+from hive.indexer import checkpoints
+from hive.indexer.checkpoints import (
+    build_index, convert_checkpoint, load_index, _read_chunks)
+
+
+def block(num):
+    return {'block_id': '%08x' % num + 'a' * 32, 'previous': '%08x' % (num - 1),
+            'timestamp': '2017-01-01T00:00:00', 'transactions': [
+                {'operations': [['vote', {'voter': 'v%d' % num, 'author': 'a',
+                                          'permlink': 'p', 'weight': 100}],
+                                ['transfer', {'from': 'a', 'to': 'b'}]]}]}
+
+
+@pytest.fixture
+def lst(tmpdir, monkeypatch):
+    monkeypatch.setattr(checkpoints, 'INDEX_STEP', 10)
+    path = str(tmpdir.join('35.json.lst'))
+    with open(path, 'w') as f:
+        for num in range(1, 36):
+            f.write(json.dumps(block(num)) + "\n")
+    return path
+
+
+def read_nums(path, skip_lines):
+    return [int(json.loads(line.decode())['block_id'][:8], 16)
+            for chunk in _read_chunks(path, skip_lines, 4) for line in chunk]
+
+
+def test_resume_builds_index(lst):
+    assert load_index(lst) is None
+    assert read_nums(lst, 23) == list(range(24, 36))
+    offsets = load_index(lst)
+    assert [line for line, _ in offsets] == [0, 10, 20, 30]
+    with open(lst, 'rb') as f:
+        for line_no, offset in offsets:
+            f.seek(offset)
+            assert json.loads(f.readline().decode()) == block(line_no + 1)
+
+
+def test_index_grows_while_reading(lst):
+    assert read_nums(lst, 0) == list(range(1, 36))
+    assert [line for line, _ in load_index(lst)] == [0, 10, 20, 30]
+
+
+def test_stale_or_corrupt_index_is_rebuilt(lst):
+    build_index(lst)
+    with open(lst, 'a') as f:
+        f.write(json.dumps(block(36)) + "\n")
+    assert load_index(lst) is None
+    assert read_nums(lst, 33) == [34, 35, 36]
+    assert load_index(lst) is not None
+
+    with open(lst + '.idx', 'w') as f:
+        f.write('{"size": ')
+    assert load_index(lst) is None
+    assert read_nums(lst, 30) == list(range(31, 37))
+    assert load_index(lst) is not None
+
+
+@pytest.mark.parametrize('ext', ['.gz', '.bz2', '.xz', '.compact'])
+def test_converted_files_resume_from_index(lst, ext):
+    out_path = convert_checkpoint(lst, ext)
+    assert [line for line, _ in load_index(out_path)] == [0, 10, 20, 30]
+    assert read_nums(out_path, 0) == list(range(1, 36))
+    assert read_nums(out_path, 27) == list(range(28, 36))
+    with pytest.raises(ValueError):
+        convert_checkpoint(lst, ext)
+
+
+def test_truncated_compact_file(lst):
+    out_path = convert_checkpoint(lst, '.compact')
+    with open(out_path, 'rb+') as f:
+        f.truncate(os.path.getsize(out_path) - 3)
+    os.remove(out_path + '.idx')
+    with pytest.raises(ValueError):
+        read_nums(out_path, 0)
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import json
+
+import pytest
+
+from hive.indexer.json_stream import iter_array
+
+BATCH = [
+    {'id': 0, 'result': {'body': 'a "quoted" \\ [bracket], {brace}', 'votes': [1, [2, 3]]}},
+    {'id': 1, 'result': 'naïve ☃ \\u escapes\n'},
+    {'id': 2, 'result': []},
+    {'id': 3, 'result': None},
+]
+
+
+def chunked(data, size):
+    return [data[i:i+size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 64, 10000])
+def test_split_across_chunks(size):
+    data = json.dumps(BATCH, ensure_ascii=False, indent=1).encode('utf-8')
+    assert list(iter_array(chunked(data, size))) == BATCH
+
+
+def test_every_split_point():
+    data = json.dumps(BATCH).encode('utf-8')
+    for i in range(len(data) + 1):
+        assert list(iter_array([data[:i], data[i:]])) == BATCH
+
+
+def test_empty_array():
+    assert list(iter_array([b' [', b' ] '])) == []
+
+
+def test_non_array_is_yielded_whole():
+    error = {'error': {'code': -32601, 'message': '[not, an, array]'}}
+    data = b'\n' + json.dumps(error).encode()
+    assert list(iter_array(chunked(data, 5))) == [error]
+
+
+def test_truncated_array():
+    data = json.dumps(BATCH).encode()
+    items = iter_array(chunked(data[:len(data) // 2], 16))
+    with pytest.raises(ValueError):
+        list(items)
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+
+os.environ.setdefault('DATABASE_URL', 'sqlite:///:memory:')
+
+import pytest
+
+from hive.db import conn
+from hive.db import methods
+from hive.indexer import accounts, cache, core, undo
+
+
+def sqlite_query(sql, **kwargs):
+    """ Run `sql` on sqlite, expanding tuple params as the mysql driver
+    does and translating the mysql-only syntax hive uses. hive_posts
+    DELETEs go row by row in scan order (primary key, or ORDER BY),
+    checking foreign keys after each row as innodb does. """
+    if sql in ('START TRANSACTION', 'COMMIT'):
+        return None
+    for key, value in list(kwargs.items()):
+        if isinstance(value, tuple):
+            names = ['%s_%d' % (key, i) for i in range(len(value))]
+            sql = sql.replace(':' + key, '(%s)' % ', '.join(':' + n for n in names))
+            kwargs.update(zip(names, value))
+            del kwargs[key]
+
+    sql = re.sub(r'VALUES\((\w+)\)', r'excluded.\1',
+                 sql.replace('ON DUPLICATE KEY UPDATE', 'ON CONFLICT DO UPDATE SET'))
+    sql = re.sub(r'(\S+) \+ INTERVAL (\d+) DAY', r"datetime(\1, '+\2 days')",
+                 sql.replace('GREATEST(', 'MAX('))
+
+    match = re.match(r'DELETE FROM hive_posts WHERE (.*?)( ORDER BY id DESC)?$', sql)
+    if not match:
+        return methods.query(sql, **kwargs)
+    order = 'DESC' if match.group(2) else 'ASC'
+    ids = [row[0] for row in methods.query(
+        "SELECT id FROM hive_posts WHERE %s ORDER BY id %s" % (match.group(1), order),
+        **kwargs).fetchall()]
+    for pid in ids:
+        methods.query("DELETE FROM hive_posts WHERE id = :id", id=pid)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    if conn.engine.name != 'sqlite':
+        pytest.skip('needs a scratch sqlite db')
+    conn.execute("PRAGMA foreign_keys = ON")
+    for ddl in [
+            "CREATE TABLE hive_undo (num INTEGER PRIMARY KEY, entries TEXT)",
+            "CREATE TABLE hive_blocks (num INTEGER PRIMARY KEY, hash TEXT)",
+            "CREATE TABLE hive_accounts (id INTEGER PRIMARY KEY, name TEXT)",
+            "CREATE TABLE hive_posts (id INTEGER PRIMARY KEY, author TEXT, "
+            "parent_id INTEGER REFERENCES hive_posts (id), is_deleted INTEGER, "
+            "permlink TEXT, created_at TEXT)",
+            "CREATE TABLE hive_posts_cache (post_id INTEGER PRIMARY KEY "
+            "REFERENCES hive_posts (id), title TEXT, is_paidout INTEGER, payout_at TEXT)",
+            "CREATE TABLE hive_post_tags (post_id INTEGER, tag TEXT)",
+            "CREATE TABLE hive_dirty_posts (post_id INTEGER PRIMARY KEY, "
+            "payout_at TEXT, touched_at TEXT)"]:
+        conn.execute(ddl)
+    query_all = lambda sql, **kw: sqlite_query(sql, **kw).fetchall()
+    query_one = lambda sql, **kw: sqlite_query(sql, **kw).scalar()
+    query_row = lambda sql, **kw: sqlite_query(sql, **kw).first()
+    for module in (undo, core, cache, accounts):
+        for name, fn in [('query', sqlite_query), ('query_all', query_all),
+                         ('query_one', query_one), ('query_row', query_row)]:
+            if hasattr(module, name):
+                monkeypatch.setattr(module, name, fn)
+    yield
+    for table in ['hive_undo', 'hive_blocks', 'hive_accounts', 'hive_post_tags',
+                  'hive_dirty_posts', 'hive_posts_cache', 'hive_posts']:
+        conn.execute("DROP TABLE %s" % table)
+
+
+def rows(table):
+    return [tuple(row) for row in conn.execute("SELECT * FROM %s ORDER BY 1" % table)]
+
+
+def test_pop_block_with_post_and_reply(db):
+    conn.execute("INSERT INTO hive_posts (id, author, parent_id, is_deleted) VALUES (1, 'alice', NULL, 0)")
+    before = rows('hive_posts')
+
+    undo.begin(5)
+    undo.snapshot('hive_posts', 'id IN :ids', ids=(2, 3))
+    conn.execute("INSERT INTO hive_posts (id, author, parent_id, is_deleted) VALUES (2, 'bob', 1, 0)")
+    conn.execute("INSERT INTO hive_posts (id, author, parent_id, is_deleted) VALUES (3, 'carol', 2, 0)")
+    undo.snapshot('hive_posts', 'id = :id', id=2)
+    conn.execute("UPDATE hive_posts SET is_deleted = 1 WHERE id = 2")
+    undo.snapshot('hive_posts', 'id = :id', id=1)
+    conn.execute("UPDATE hive_posts SET is_deleted = 1 WHERE id = 1")
+    undo.recache([2, 3])
+    conn.execute("INSERT INTO hive_posts_cache (post_id, title) VALUES (2, 'reply')")
+    undo.end()
+    assert not undo.is_recording()
+
+    assert undo.recached(5) == {2, 3}
+    assert undo.pop_block(5) == {2, 3}
+    assert rows('hive_posts') == before
+    assert rows('hive_posts_cache') == []
+    assert rows('hive_undo') == []
+
+
+def test_snapshots_are_undone_in_reverse(db):
+    conn.execute("INSERT INTO hive_posts (id, author, parent_id, is_deleted) VALUES (1, 'alice', NULL, 0)")
+
+    undo.begin(7)
+    undo.snapshot('hive_posts', 'id = :id', id=1)
+    conn.execute("UPDATE hive_posts SET is_deleted = 1 WHERE id = 1")
+    undo.snapshot('hive_posts', 'id = :id', id=1)
+    conn.execute("UPDATE hive_posts SET author = 'mallory' WHERE id = 1")
+    undo.end()
+
+    undo.pop_block(7)
+    assert rows('hive_posts') == [(1, 'alice', None, 0, None, None)]
+
+
+def test_not_recording(db):
+    undo.snapshot('hive_posts', 'id = :id', id=1)
+    undo.recache([1])
+    undo.end()
+    assert rows('hive_undo') == []
+    with pytest.raises(Exception):
+        undo.pop_block(1)
+
+
+class ForkedSteemd(object):
+    """ Serves a chain which agrees with ours up to block 2. """
+
+    def get_block(self, num):
+        return {'block_id': 'h%d' % num if num <= 2 else 'fork%d' % num}
+
+    def head_time(self):
+        return '2017-01-01 00:10:00'
+
+
+def test_pop_fork_with_deferred_cache(db):
+    conn.execute("INSERT INTO hive_blocks VALUES (1, 'h1'), (2, 'h2')")
+    conn.execute("INSERT INTO hive_posts VALUES "
+                 "(1, 'alice', NULL, 0, 'p1', '2017-01-01 00:00:00')")
+    conn.execute("INSERT INTO hive_posts_cache VALUES (1, 'p1', 0, '2017-01-08 00:00:00')")
+
+    # block 3 replies to post 1 and is queued for the cache worker
+    undo.begin(3)
+    undo.snapshot('hive_blocks', 'num = :num', num=3)
+    conn.execute("INSERT INTO hive_blocks VALUES (3, 'h3')")
+    undo.snapshot('hive_posts', 'id IN :ids', ids=(2,))
+    conn.execute("INSERT INTO hive_posts VALUES "
+                 "(2, 'bob', 1, 0, 'c1', '2017-01-01 00:00:09')")
+    core.defer_posts([1, 2], '2017-01-01 00:00:09')
+    undo.end()
+    assert [row[0] for row in rows('hive_dirty_posts')] == [1, 2]
+
+    # the worker refreshes both before block 3 is irreversible
+    conn.execute("UPDATE hive_posts_cache SET title = 'p1 (3)' WHERE post_id = 1")
+    conn.execute("INSERT INTO hive_posts_cache VALUES (2, 'c1', 0, '2017-01-08 00:00:09')")
+    conn.execute("DELETE FROM hive_dirty_posts")
+
+    assert core.pop_fork(ForkedSteemd(), defer_cache=True) == (2, 'h2')
+    assert [row[0] for row in rows('hive_blocks')] == [1, 2]
+    assert [row[0] for row in rows('hive_posts')] == [1]
+    # post 1's cache was written from the forked-out chain: redo it
+    assert rows('hive_posts_cache') == []
+    assert rows('hive_dirty_posts') == [(1, '2017-01-08 00:00:00', '2017-01-01 00:10:00')]
+    assert rows('hive_undo') == []
+
+
+class LaggingSteemd(ForkedSteemd):
+    """ Agrees with our chain, but has not seen block 3 at first. """
+
+    def __init__(self):
+        self.misses = 2
+
+    def get_block(self, num):
+        if num == 3 and self.misses:
+            self.misses -= 1
+            return None
+        return {'block_id': 'h%d' % num}
+
+
+def test_pop_fork_waits_for_lagging_node(db, monkeypatch):
+    monkeypatch.setattr(core.time, 'sleep', lambda secs: None)
+    conn.execute("INSERT INTO hive_blocks VALUES (1, 'h1'), (2, 'h2'), (3, 'h3')")
+    steemd = LaggingSteemd()
+    assert core.pop_fork(steemd) == (3, 'h3')
+    assert steemd.misses == 0
+    assert [row[0] for row in rows('hive_blocks')] == [1, 2, 3]